@@ -10,6 +10,9 @@ idea: python3/pygame 2d vector dungeon crawl roguelike
 import pygame
 import random
 import os
+import collections
+import json
+import time
 
 def mouseVector():
     return pygame.math.Vector2(pygame.mouse.get_pos()[0],
@@ -21,12 +24,177 @@ def randomize_color(color, delta=50):
     color = max(0, color)
     return color
 
+fonts = {} # { (name, size, bold): pygame font }, see get_font
+
+def get_font(name=None, size=24, bold=False):
+    """returns a pygame font. SysFont is slow, so each (name, size, bold) is created
+       only once (when it is first needed) and then reused by write and make_text"""
+    key = (name, size, bold)
+    if key not in fonts:
+        fonts[key] = pygame.font.SysFont(name, size, bold=bold)
+    return fonts[key]
+
+masks = collections.OrderedDict() # { id(Surface): (Surface, Mask) }, see get_mask
+maxmasks = 512 # the least recently used masks are forgotten first
+
+def get_mask(image):
+    """returns the collision mask of image, for pygame.sprite.collide_mask. Images are
+       shared (Assets, Rotcache), so each mask is made only once. The image is kept in masks,
+       so its id can not be reused by another Surface"""
+    entry = masks.get(id(image))
+    if entry is None:
+        entry = (image, pygame.mask.from_surface(image))
+        masks[id(image)] = entry
+        if len(masks) > maxmasks:
+            masks.popitem(last=False)
+    else:
+        masks.move_to_end(id(image))
+    return entry[1]
+
+class Textcache():
+    """LRU cache of rendered text surfaces, used by write() and make_text().
+       Text that did not change since the last frame (gold, log lines, menu items)
+       costs only a blit. When the surfaces need more than Textcache.maxbytes,
+       the least recently used ones are forgotten"""
+    
+    book = collections.OrderedDict() # { (text, font, size, bold, color, antialias, alpha): Surface }
+    maxbytes = 4 * 1024 * 1024 # memory cap for all cached surfaces
+    bytes = 0
+    hits = 0
+    misses = 0
+    
+    @staticmethod
+    def render(text, color, fontname=None, size=24, bold=False, antialias=True, alpha=False):
+        """returns the rendered text as (shared!) Surface. Do not draw on it.
+           alpha=True converts the surface with convert_alpha()"""
+        key = (text, fontname, size, bold, tuple(color), antialias, alpha)
+        surface = Textcache.book.get(key)
+        if surface is not None:
+            Textcache.hits += 1
+            Textcache.book.move_to_end(key)
+            return surface
+        Textcache.misses += 1
+        surface = get_font(fontname, size, bold).render(text, antialias, color)
+        if alpha:
+            surface = surface.convert_alpha()
+        Textcache.book[key] = surface
+        Textcache.bytes += surface.get_pitch() * surface.get_height()
+        while Textcache.bytes > Textcache.maxbytes and len(Textcache.book) > 1:
+            _, old = Textcache.book.popitem(last=False)
+            Textcache.bytes -= old.get_pitch() * old.get_height()
+        return surface
+
+
+class Rotcache():
+    """LRU cache of rotated images, used by VectorSprite.rotate and set_angle.
+       The angle is rounded to a multiple of Rotcache.step degree, so all sprites
+       with the same source image (image0) share the rotated images. When the images
+       need more than Rotcache.maxbytes, the least recently used ones are forgotten"""
+    
+    book = collections.OrderedDict() # { (id of source, degree): (source, rotated Surface) }
+    step = 3 # degree, smaller is smoother but needs more memory
+    maxbytes = 8 * 1024 * 1024 # memory cap for all cached surfaces
+    bytes = 0
+    hits = 0
+    misses = 0
+    
+    @staticmethod
+    def rotate(image, angle):
+        """returns image rotated by angle (rounded to Rotcache.step) as shared Surface.
+           Do not draw on it"""
+        steps = round(angle / Rotcache.step) % round(360 / Rotcache.step)
+        if steps == 0:
+            return image
+        # the source is kept in the cache, so its id can not be reused by another Surface.
+        # The key is the rounded angle in degree, so it stays right if Rotcache.step changes
+        key = (id(image), steps * Rotcache.step)
+        entry = Rotcache.book.get(key)
+        if entry is not None:
+            Rotcache.hits += 1
+            Rotcache.book.move_to_end(key)
+            return entry[1]
+        Rotcache.misses += 1
+        surface = pygame.transform.rotate(image, steps * Rotcache.step)
+        Rotcache.book[key] = (image, surface)
+        Rotcache.bytes += surface.get_pitch() * surface.get_height()
+        while Rotcache.bytes > Rotcache.maxbytes and len(Rotcache.book) > 1:
+            _, (_, old) = Rotcache.book.popitem(last=False)
+            Rotcache.bytes -= old.get_pitch() * old.get_height()
+        return surface
+
+
+class Assets():
+    """images from the 'data' folder. A picture is loaded when it is first needed
+       (get), converted once to the pixel format of the display and then shared by
+       all sprites. Derived pictures (scaled, flipped) are also made only once.
+       all sprites that can rotate MUST look to the right. Edit Image files manually if necessary!"""
+    
+    folder = "data"
+    # name: (filename, size or None for original size)
+    files = {"wizard":     ("arch-mage.png", None),
+             "wizard-a":   ("arch-mage-attack.png", None),
+             "reptile":    ("fighter.png", None),
+             "reptile-a":  ("fighter-attack.png", None),
+             "wolf":       ("wolf.png", None),
+             "wolf-a":     ("wolf-attack.png", None),
+             "chest":      ("chest-plain-closed.png", None),
+             "chest-a":    ("chest-plain-open.png", None),
+             "cannon":     ("cannon.png", None),
+             # --- boss images (scaled to be bigger) ---
+             "bosswolf":   ("wolf.png", (150,150)),
+             "bosswolf-a": ("wolf-attack.png", (150,150)),
+            }
+    images = {}   # filename: converted Surface, as loaded from disk
+    variants = {} # (name, size, flipx, flipy): Surface
+    loads = 0     # number of files read from disk
+    seconds = 0   # time spent reading and converting files
+    hits = 0
+    misses = 0
+    
+    @staticmethod
+    def load(filename):
+        """reads filename from the data folder (only once) and converts it for fast blitting"""
+        if filename not in Assets.images:
+            start = time.perf_counter()
+            surface = pygame.image.load(os.path.join(Assets.folder, filename))
+            if pygame.display.get_surface() is not None:
+                surface = surface.convert_alpha()
+            Assets.images[filename] = surface
+            Assets.loads += 1
+            Assets.seconds += time.perf_counter() - start
+        return Assets.images[filename]
+    
+    @staticmethod
+    def get(name, size=None, flipx=False, flipy=False):
+        """returns the shared Surface for name (see Assets.files), optionally
+           scaled to size=(width, height) and/or flipped. Do not draw on it"""
+        key = (name, size, flipx, flipy)
+        if key in Assets.variants:
+            Assets.hits += 1
+            return Assets.variants[key]
+        Assets.misses += 1
+        filename, filesize = Assets.files.get(name, (name, None))
+        if size is None:
+            size = filesize
+        surface = Assets.load(filename)
+        if size is not None and size != surface.get_size():
+            surface = pygame.transform.scale(surface, size)
+        if flipx or flipy:
+            surface = pygame.transform.flip(surface, flipx, flipy)
+        Assets.variants[key] = surface
+        return surface
+    
+    @staticmethod
+    def stats():
+        """returns a string with load statistics"""
+        return "assets: {} files loaded in {:.3f} s, {} variants, {} hits, {} misses".format(
+                Assets.loads, Assets.seconds, len(Assets.variants), Assets.hits, Assets.misses)
+
+
 def make_text(msg="pygame is cool", fontcolor=(255, 0, 255), fontsize=42, font=None):
-    """returns pygame surface with text. You still need to blit the surface."""
-    myfont = pygame.font.SysFont(font, fontsize)
-    mytext = myfont.render(msg, True, fontcolor)
-    mytext = mytext.convert_alpha()
-    return mytext
+    """returns pygame surface with text. You still need to blit the surface.
+       The surface comes from the Textcache and is shared, do not draw on it"""
+    return Textcache.render(msg, fontcolor, font, fontsize, alpha=True)
 
 def write(background, text="bla", pos=None, color=(0,0,0),
           fontsize=None, center=False, x=None, y=None):
@@ -40,9 +208,8 @@ def write(background, text="bla", pos=None, color=(0,0,0),
             y = -pos.y
         if fontsize is None:
             fontsize = 24
-        font = pygame.font.SysFont('mono', fontsize, bold=True)
-        fw, fh = font.size(text)
-        surface = font.render(text, True, color)
+        surface = Textcache.render(text, color, 'mono', fontsize, bold=True)
+        fw, fh = surface.get_size()
         if center: # center text around x,y
             background.blit(surface, (x-fw//2, y-fh//2))
         else:      # topleft corner is x,y
@@ -83,10 +250,10 @@ def elastic_collision(sprite1, sprite2):
 
 
 def fight(attacker, defender):
-    Viewer.log.append([(0,255,0), "{} strikes at {}".format(attacker.__class__.__name__, defender.__class__.__name__)])
+    Viewer.log.append(Logentry("strikes at", attacker.__class__.__name__, defender.__class__.__name__))
     strike(attacker, defender)
     if defender.hitpoints > 0:
-        Viewer.log.append([(0,200,0),"{} strikes back against {}".format(defender.__class__.__name__, attacker.__class__.__name__)])
+        Viewer.log.append(Logentry("strikes back", defender.__class__.__name__, attacker.__class__.__name__))
         strike(defender, attacker)
         
 def strike(attacker, defender):
@@ -113,13 +280,9 @@ def strike(attacker, defender):
             move = m,
             color = (200,0,0) if damage > 0 else (20,20,20), max_age=2,
             fontsize=60)
-    text = "hit!" if damage > 0 else "fail..."
-    text += " attack+2d6 = {} + {} + {} = {} Vs. defense+2d6 = {} + {} + {} = {}".format(
-            attacker.attack, d1, d2, attacker.attack+d1+d2, defender.defense, d3, d4, defender.defense + d3+d4)
-    if damage > 0:
-        text += "  DAMAGE {} HP".format(damage)
     defender.hitpoints -= damage
-    Viewer.log.append([(255,255,255), text])
+    Viewer.log.append(Logentry("strike", attacker.__class__.__name__, defender.__class__.__name__,
+                               attacker.attack, defender.defense, (d1, d2, d3, d4), damage))
                 
                 
     
@@ -178,17 +341,262 @@ class PatrolState(State):
         return self
 
 
-class VectorSprite(pygame.sprite.Sprite):
-    """base class for sprites. this class inherits from pygames sprite class"""
+class Occupancy():
+    """tile-keyed index of everything that can block a tile:
+       walls, shops, chests, monsters and the player.
+       key is the tile (x, y), y axis goes positive down (like Room).
+       Sprites register themselves in VectorSprite.__init__ and unregister in kill(),
+       moving sprites must call Occupancy.moved(sprite) after changing their pos.
+       Turn resolution in Viewer.run asks the index instead of scanning sprite groups.
+       Tiles are cells of the movement grid (walls, shops and steps are 50 pixel apart),
+       not of Viewer.tilesize, which only changes the painted grid"""
+    
+    grid = 50 # pixel between two tiles
+    book = {} # { kind: { (x,y): [sprite, ...] } }
+    version = 0 # increases whenever a wall is built or destroyed
+    biggest = 0 # biggest width or height of a registered sprite, see near
+    
+    @staticmethod
+    def tile(pos):
+        """converts a pygame position (y negative) into a tile (x, y)"""
+        return (int(round(pos.x / Occupancy.grid)), int(round(-pos.y / Occupancy.grid)))
+    
+    @staticmethod
+    def add(sprite):
+        sprite.tile = Occupancy.tile(sprite.pos)
+        Occupancy.book.setdefault(sprite.occupant, {}).setdefault(sprite.tile, []).append(sprite)
+        Occupancy.biggest = max(Occupancy.biggest, sprite.rect.width, sprite.rect.height)
+        if sprite.occupant == "wall":
+            Occupancy.version += 1
+    
+    @staticmethod
+    def remove(sprite):
+        tiles = Occupancy.book.get(sprite.occupant, {})
+        here = tiles.get(sprite.tile, [])
+        if sprite in here:
+            here.remove(sprite)
+            if len(here) == 0:
+                del tiles[sprite.tile]
+            if sprite.occupant == "wall":
+                Occupancy.version += 1
+    
+    @staticmethod
+    def moved(sprite):
+        """call this after changing the pos of a registered sprite"""
+        if Occupancy.tile(sprite.pos) != sprite.tile:
+            Occupancy.remove(sprite)
+            Occupancy.add(sprite)
+    
+    @staticmethod
+    def get(kind, tile):
+        """returns the first sprite of kind ("wall", "shop", "chest", "monster", "player")
+           standing on tile or None"""
+        here = Occupancy.book.get(kind, {}).get(tile)
+        if here:
+            return here[0]
+        return None
+    
+    @staticmethod
+    def near(kinds, rect):
+        """returns all sprites of kinds (e.g. ("monster", "chest")) that could overlap rect 
+           (pygame rect like sprite.rect). Only the tiles around rect are looked at,
+           so the cost does not grow with the number of sprites in the level"""
+        ts = Occupancy.grid
+        # --- a sprite can reach biggest/2 pixel from the center of its tile, 
+        #     plus one tile if it has moved (Occupancy.moved) but its rect is not yet updated ---
+        r = rect.inflate(Occupancy.biggest + 2 * ts, Occupancy.biggest + 2 * ts)
+        found = []
+        for kind in kinds:
+            tiles = Occupancy.book.get(kind, {})
+            for y in range(int(round(r.top / ts)), int(round(r.bottom / ts)) + 1):
+                for x in range(int(round(r.left / ts)), int(round(r.right / ts)) + 1):
+                    found.extend(tiles.get((x, y), ()))
+        return found
+    
+    @staticmethod
+    def clear():
+        Occupancy.book = {}
+        Occupancy.version += 1
+
+
+class Flowfield():
+    """distance map toward the player, shared by all Monsters.
+       Once per turn a breadth-first search runs over the tile grid, starting at the
+       player's tile and flowing around walls. Each Monster then finds its next step
+       with a single neighbour lookup instead of searching on its own.
+       The field is only recalculated if the player moved or a wall was built/destroyed"""
+    
+    distance = {} # { (x,y): steps to the player }
+    origin = None # tile of the player when the field was calculated
+    version = None # Occupancy.version when the field was calculated
+    radius = 30 # in tiles. Monsters further away than that are not in the field
+    neighbours = ((-1,-1), (0,-1), (1,-1), (-1,0), (1,0), (-1,1), (0,1), (1,1))
+    
+    @staticmethod
+    def update(playertile):
+        """recalculate the field if necessary. Call this once per turn"""
+        if playertile == Flowfield.origin and Occupancy.version == Flowfield.version:
+            return # nothing has changed, keep the old field
+        walls = Occupancy.book.get("wall", {})
+        px, py = playertile
+        distance = {playertile: 0}
+        todo = collections.deque([playertile])
+        while todo:
+            tile = todo.popleft()
+            steps = distance[tile] + 1
+            for (dx, dy) in Flowfield.neighbours:
+                x, y = tile[0] + dx, tile[1] + dy
+                if abs(x - px) > Flowfield.radius or abs(y - py) > Flowfield.radius:
+                    continue
+                if (x, y) in distance or (x, y) in walls:
+                    continue
+                distance[(x, y)] = steps
+                todo.append((x, y))
+        Flowfield.distance = distance
+        Flowfield.origin = playertile
+        Flowfield.version = Occupancy.version
+    
+    @staticmethod
+    def next_step(tile):
+        """returns the neighbour tile that is closest to the player and not occupied 
+           by another monster or chest, or None if there is no better tile"""
+        best = None
+        beststeps = Flowfield.distance.get(tile)
+        if beststeps is None:
+            return None
+        for (dx, dy) in Flowfield.neighbours:
+            t = (tile[0] + dx, tile[1] + dy)
+            steps = Flowfield.distance.get(t)
+            if steps is None or steps >= beststeps:
+                continue
+            if Occupancy.get("monster", t) is not None or Occupancy.get("chest", t) is not None:
+                continue
+            best, beststeps = t, steps
+        return best
+
+
+class Prototypes():
+    """fully initialized default state of a sprite class (Monsters, Bar, Fireball).
+       The state is built once per class, spawn makes new sprites by copying it
+       instead of running _default_parameters, _overwrite_parameters and create_image again.
+       Values that must differ per sprite (random values, the hitpoint Bar) come from
+       _spawn_parameters. spawn only takes the keywords in Prototypes.keywords, which no
+       _overwrite_parameters changes, so spawn(cls, **kwargs) gives the same sprite as cls(**kwargs)"""
+    
+    keywords = ("pos", "move", "bossnumber")
+    states = {} # { class: { attribute: value } }
+    builds = 0
+    clones = 0
+    
+    @staticmethod
+    def build(cls):
+        """returns the default state of cls. The prototype is in no group, has no
+           number and is not in the Occupancy index"""
+        sprite = cls.__new__(cls)
+        sprite._default_parameters(pos=pygame.math.Vector2(0, 0))
+        sprite._overwrite_parameters()
+        sprite.create_image()
+        if sprite.angle != 0:
+            sprite.set_angle(sprite.angle)
+        state = dict(sprite.__dict__) # without pygame's Sprite values, spawn calls DirtySprite.__init__
+        Prototypes.states[cls] = state
+        Prototypes.builds += 1
+        return state
+    
+    @staticmethod
+    def spawn(cls, **kwargs):
+        """returns a new sprite of cls, like cls(**kwargs) but without making images"""
+        for key in kwargs:
+            if key not in Prototypes.keywords:
+                raise TypeError("Prototypes.spawn takes only {}, not {}: use {}(...) instead".format(
+                                ", ".join(Prototypes.keywords), key, cls.__name__))
+        state = Prototypes.states.get(cls)
+        if state is None:
+            state = Prototypes.build(cls)
+        sprite = cls.__new__(cls)
+        sprite.__dict__.update(state)
+        # --- mutable values are changed in place (pos += ...), every sprite needs its own ---
+        sprite.pos = pygame.math.Vector2(state["pos"])
+        sprite.move = pygame.math.Vector2(state["move"])
+        if "rect" in state:
+            sprite.rect = state["rect"].copy()
+        for key, arg in kwargs.items():
+            setattr(sprite, key, arg)
+        # --- the same steps as VectorSprite.__init__ ---
+        VectorSprite.number += 1
+        VectorSprite.numbers[VectorSprite.number] = sprite
+        sprite._spawn_parameters()
+        pygame.sprite.DirtySprite.__init__(sprite, sprite.groups)
+        sprite.number = VectorSprite.number
+        if "rect" not in state:
+            sprite.create_image() # the image depends on other sprites, like the boss of a Bar
+        sprite.distance_traveled = 0
+        sprite.tail = []
+        sprite.drawn = None
+        if sprite.occupant is not None:
+            Occupancy.add(sprite)
+        Prototypes.clones += 1
+        return sprite
+    
+    @staticmethod
+    def stats():
+        """returns a string with spawn statistics"""
+        return "prototypes: {} built, {} sprites spawned".format(Prototypes.builds, Prototypes.clones)
+
+
+class VectorSprite(pygame.sprite.DirtySprite):
+    """base class for sprites. this class inherits from pygames (dirty) sprite class.
+       dirty is set to 1 when image or position changed, see Viewer.dirtyrects"""
     number = 0
     numbers = {} # { number, Sprite }
+    occupant = None # kind of sprite in the Occupancy index, None for not blocking
+    hpversion = 0 # counts changes of hitpoints and hitpointsfull, see Bar
+    # --- defaults for missing keywords, a sprite stores only what differs ---
+    _layer = 4
+    _hitpoints = 100
+    _hitpointsfull = 100
+    static = False
+    selected = False
+    fontsize = 22
+    friction = 1.0 # no friction
+    radius = 5
+    width = 10 # radius * 2
+    height = 10
+    mass = 15
+    damage = 10
+    bounce_on_edge = False
+    kill_on_edge = False
+    angle = 0 # facing right?
+    max_age = None
+    max_distance = None
+    picture = None
+    bossnumber = None
+    kill_with_boss = False
+    sticky_with_boss = False
+    upkey = None
+    downkey = None
+    rightkey = None
+    leftkey = None
+    speed = 0
+    age = 0 # age in seconds
+    warp_on_edge = False
+    gravity = None
+    survive_north = False
+    survive_south = False
+    survive_west = False
+    survive_east = False
+    ydistance = 0
+    always_create_image = False
+    bounty = 0
+    gold = 0
 
     def __init__(self, **kwargs):
         self._default_parameters(**kwargs)
         VectorSprite.number += 1
         VectorSprite.numbers[self.number] = self
         self._overwrite_parameters()
-        pygame.sprite.Sprite.__init__(self, self.groups) #call parent class. NEVER FORGET !
+        self._spawn_parameters()
+        pygame.sprite.DirtySprite.__init__(self, self.groups) #call parent class. NEVER FORGET !
         self.number = VectorSprite.number # unique number for each sprite
 
         self.create_image()
@@ -197,103 +605,58 @@ class VectorSprite(pygame.sprite.Sprite):
         if self.angle != 0:
             self.set_angle(self.angle)
         self.tail = [] 
+        self.drawn = None # (image, topleft) when dirty was last set
+        if self.occupant is not None:
+            Occupancy.add(self)
 
     def _overwrite_parameters(self):
         """change parameters before create_image is called""" 
         pass
 
-    def _default_parameters(self, **kwargs):    
-        """get unlimited named arguments and turn them into attributes
-           default values for missing keywords"""
+    def _spawn_parameters(self):
+        """values that can not be copied from a prototype (see Prototypes), 
+           like random values or other sprites. called after _overwrite_parameters"""
+        pass
 
-        for key, arg in kwargs.items():
-            setattr(self, key, arg)
-        if "layer" not in kwargs:
-            self._layer = 4
-        else:
-            self._layer = self.layer
-        if "static" not in kwargs:
-            self.static = False
-        if "selected" not in kwargs:
-            self.selected = False
+    @property
+    def hitpoints(self):
+        return self._hitpoints
+
+    @hitpoints.setter
+    def hitpoints(self, value):
+        self._hitpoints = value
+        self.hpversion += 1
+
+    @property
+    def hitpointsfull(self):
+        return self._hitpointsfull
+
+    @hitpointsfull.setter
+    def hitpointsfull(self, value):
+        self._hitpointsfull = value
+        self.hpversion += 1
+
+    def _default_parameters(self, **kwargs):
+        """get unlimited named arguments and turn them into attributes in one pass.
+           missing keywords fall back to the class attributes (see defaults above),
+           only the values that differ per sprite are created here"""
+        if "layer" in kwargs:
+            self._layer = kwargs.pop("layer")
+        kwargs.pop("hitpointsfull", None) # always a copy of hitpoints
+        hitpoints = kwargs.pop("hitpoints", None)
+        self.__dict__.update(kwargs)
+        if hitpoints is not None:
+            self.hitpoints = hitpoints
+            self.hitpointsfull = hitpoints # makes a copy
         if "pos" not in kwargs:
             self.pos = pygame.math.Vector2(random.randint(0, Viewer.width),-50)
         if "move" not in kwargs:
             self.move = pygame.math.Vector2(0,0)
-        if "fontsize" not in kwargs:
-            self.fontsize = 22
-        if "friction" not in kwargs:
-            self.friction = 1.0 # no friction
-        if "radius" not in kwargs:
-            self.radius = 5
-        if "width" not in kwargs:
-            self.width = self.radius * 2
-        if "height" not in kwargs:
-            self.height = self.radius * 2
-        
-        if "hitpoints" not in kwargs:
-            self.hitpoints = 100
-        self.hitpointsfull = self.hitpoints # makes a copy
-        if "mass" not in kwargs:
-            self.mass = 10
-        if "damage" not in kwargs:
-            self.damage = 10
-        if "bounce_on_edge" not in kwargs:
-            self.bounce_on_edge = False
-        if "kill_on_edge" not in kwargs:
-            self.kill_on_edge = False
-        if "angle" not in kwargs:
-            self.angle = 0 # facing right?
-        if "max_age" not in kwargs:
-            self.max_age = None
-        if "max_distance" not in kwargs:
-            self.max_distance = None
-        if "picture" not in kwargs:
-            self.picture = None
-        if "bossnumber" not in kwargs:
-            self.bossnumber = None
-        if "kill_with_boss" not in kwargs:
-            self.kill_with_boss = False
-        if "sticky_with_boss" not in kwargs:
-            self.sticky_with_boss = False
-        if "mass" not in kwargs:
-            self.mass = 15
-        if "upkey" not in kwargs:
-            self.upkey = None
-        if "downkey" not in kwargs:
-            self.downkey = None
-        if "rightkey" not in kwargs:
-            self.rightkey = None
-        if "leftkey" not in kwargs:
-            self.leftkey = None
-        if "speed" not in kwargs:
-            self.speed = None
-        if "age" not in kwargs:
-            self.age = 0 # age in seconds
-        if "warp_on_edge" not in kwargs:
-            self.warp_on_edge = False
-        if "gravity" not in kwargs:
-            self.gravity = None
-        if "survive_north" not in kwargs:
-            self.survive_north = False
-        if "survive_south" not in kwargs:
-            self.survive_south = False
-        if "survive_west" not in kwargs:
-            self.survive_west = False
-        if "survive_east" not in kwargs:
-            self.survive_east = False
-        if "speed" not in kwargs:
-            self.speed = 0
-        if "gravity" not in kwargs:
-            self.gravity = None
-        if "ydistance" not in kwargs:
-            self.ydistance = 0
-        if "always_create_image" not in kwargs:
-            self.always_create_image = False
-        if "bounty" not in kwargs:
-            self.bounty = 0
-        if "gold" not in kwargs:
-            self.gold = 0
+        if "radius" in kwargs:
+            if "width" not in kwargs:
+                self.width = self.radius * 2
+            if "height" not in kwargs:
+                self.height = self.radius * 2
         if "color" not in kwargs:
             self.color = (random.randint(0,255), random.randint(0,255), random.randint(0,255))
 
@@ -301,6 +664,8 @@ class VectorSprite(pygame.sprite.Sprite):
         
         if self.number in self.numbers:
            del VectorSprite.numbers[self.number] # remove Sprite from numbers dict
+        if self.occupant is not None:
+            Occupancy.remove(self)
         
         if self.bounty > 0:
             VectorSprite.numbers[1].gold += self.bounty 
@@ -344,20 +709,24 @@ class VectorSprite(pygame.sprite.Sprite):
         """rotates a sprite and changes it's angle by by_degree"""
         self.angle += by_degree
         oldcenter = self.rect.center
-        self.image = pygame.transform.rotate(self.image0, self.angle)
-        self.image.convert_alpha()
+        self.image = Rotcache.rotate(self.image0, self.angle)
+        if getattr(self, "mask", None) is not None: # sprites without mask get one from collide_mask
+            self.mask = get_mask(self.image)
         self.rect = self.image.get_rect()
         self.rect.center = oldcenter
+        self.dirty = 1
 
     def set_angle(self, degree):
         """rotates a sprite and changes it's angle to degree"""
         self.angle = degree
         oldcenter = self.rect.center
-        self.image = pygame.transform.rotate(self.image0, self.angle)
+        self.image = Rotcache.rotate(self.image0, self.angle)
         #self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
+        if getattr(self, "mask", None) is not None: # sprites without mask get one from collide_mask
+            self.mask = get_mask(self.image)
         self.rect = self.image.get_rect()
         self.rect.center = oldcenter
+        self.dirty = 1
 
     #def update(self, seconds):
     #    """calculate movement, position and bouncing on edge"""
@@ -406,17 +775,15 @@ class VectorSprite(pygame.sprite.Sprite):
             self.create_image()
         # ---- movement with/without boss ----
         if self.bossnumber is not None:
+            boss = VectorSprite.numbers.get(self.bossnumber)
             if self.kill_with_boss:
-                if self.bossnumber not in VectorSprite.numbers:
-                    self.kill()
-                elif VectorSprite.numbers[self.bossnumber].hitpoints <= 0:
+                if boss is None or boss.hitpoints <= 0:
                     self.kill()
-            if self.sticky_with_boss and self.bossnumber in VectorSprite.numbers:
-
-                boss = VectorSprite.numbers[self.bossnumber]
+            if self.sticky_with_boss and boss is not None:
                 #print("bosspos", boss.pos)
                 self.pos = boss.pos # pygame.math.Vector2(boss.pos.x, boss.pos.y)
-                self.set_angle(boss.angle)
+                if boss.angle != self.angle:
+                    self.set_angle(boss.angle)
                 #print(self.number, self.bossnumber, boss)
         self.pos += self.move * seconds
         self.move *= self.friction
@@ -424,6 +791,11 @@ class VectorSprite(pygame.sprite.Sprite):
         self.age += seconds
         #self.wallbounce()
         self.rect.center = (round(self.pos.x, 0), -round(self.pos.y, 0) + self.ydistance)
+        # ---- dirty: paint again (only needed for Viewer.dirtyrects) ----
+        drawn = (self.image, self.rect.topleft)
+        if drawn != self.drawn:
+            self.dirty = 1
+            self.drawn = drawn
         #if self.sticky_with_boss:
         #    print("self pos", self.pos)
         #    print("self rect center", self.rect.center)
@@ -513,22 +885,32 @@ class Hitpointbar(VectorSprite):
 
 class Bar(VectorSprite):
     
+    images = {} # { (width, filled width, color): Surface }, shared by all bars
+    
     def _overwrite_parameters(self):
         self._layer = 19
         self.ydistance = -37
         self.width = 50
         self.sticky_with_boss = True
         self.kill_with_boss = True
-        self.always_create_image = True
+        self.hpseen = -1 # hpversion of the boss when the bar was painted
         #print("ich bin bar, meine Nummmer, meine bossnumber:", self.number, self.bossnumber)
+    
+    def update(self, seconds):
+        """paint the bar again only if hitpoints of the boss have changed"""
+        boss = VectorSprite.numbers.get(self.bossnumber)
+        if boss is not None and boss.hpversion != self.hpseen:
+            self.create_image()
+            self.set_angle(boss.angle)
+        VectorSprite.update(self, seconds)
           
     def create_image(self):
         try:
             boss = VectorSprite.numbers[self.bossnumber]
         except:
             return
+        self.hpseen = boss.hpversion
         width = self.width
-        self.image = pygame.Surface((width,10)) # size of rect
         percent = boss.hitpoints / boss.hitpointsfull
         w2 = int(width * percent)
         # moving inside filling
@@ -536,36 +918,47 @@ class Bar(VectorSprite):
             c = (0,200,0)
         else:
             c = (200,200,200)
-        pygame.draw.rect(self.image,c, (1,1,w2,8)) 
-        # static outside border
-        pygame.draw.rect(self.image, (200,200,200), (0,0,width,10),1)
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
+        if (width, w2, c) not in Bar.images:
+            image = pygame.Surface((width,10)) # size of rect
+            pygame.draw.rect(image,c, (1,1,w2,8)) 
+            # static outside border
+            pygame.draw.rect(image, (200,200,200), (0,0,width,10),1)
+            image.set_colorkey((0,0,0))
+            image.convert_alpha()
+            Bar.images[(width, w2, c)] = image
+        self.image = Bar.images[(width, w2, c)]
         self.rect= self.image.get_rect()
-        self.image0 = self.image.copy()
+        self.image0 = self.image
         #self.rect.centerx = boss.rect.centerx
         #self.rect.centerx = boss.rect.centerx
         #self.rect.centery = boss.rect.centery - 100
     
 class Fireball(VectorSprite):
     
+    images = {} # { color: Surface }, shared by all fireballs of this color (and their mask)
+    
     def _overwrite_parameters(self):
         self.hitpoints = 1
         self.color = (255,0,255)
         
     def create_image(self):
-        self.image = pygame.Surface((10,10))
-        #self.image.fill(self.color)
-        pygame.draw.circle(self.image, self.color, (5,5),5)
-        #pygame.draw.rect(self.image, (0,0,0), (0,0,49,49),1)
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
-        self.image0 = self.image.copy()
+        if self.color not in Fireball.images:
+            image = pygame.Surface((10,10))
+            #image.fill(self.color)
+            pygame.draw.circle(image, self.color, (5,5),5)
+            #pygame.draw.rect(image, (0,0,0), (0,0,49,49),1)
+            image.set_colorkey((0,0,0))
+            Fireball.images[self.color] = image.convert_alpha()
+        self.image = Fireball.images[self.color]
+        self.image0 = self.image
+        self.mask = get_mask(self.image)
         self.rect = self.image.get_rect()
         
         
 class Wall(VectorSprite):
     
+    occupant = "wall"
+    
     def _overwrite_parameters(self):
         self.color = (139, 105, 20)
         self.hitpoints = 1
@@ -647,6 +1040,9 @@ class WallBorder(Wall):
 
 class Monster(VectorSprite):
     
+    occupant = "monster"
+    bar = False # True: a hitpoint Bar follows the monster
+    
     def _overwrite_parameters(self):
         self.lookright = True
         self.attacktime = 0
@@ -661,38 +1057,50 @@ class Monster(VectorSprite):
         self.state = NoneState()  # PatrolState() / SleepState()
         #self.state = SleepingState()
 
+    def _spawn_parameters(self):
+        if self.bar:
+            Prototypes.spawn(Bar, bossnumber=self.number)
+
     def on_event(self, event):
         self.state = self.state.on_event(event)
 
 
     def run_to_player(self):
+            """next step toward the player, following the shared Flowfield around walls"""
+            step = Flowfield.next_step(self.tile)
+            if step is not None:
+                return ((step[0] - self.tile[0]) * Occupancy.grid,
+                        -(step[1] - self.tile[1]) * Occupancy.grid)
+            if self.tile in Flowfield.distance:
+                return 0, 0 # no better tile free, wait
+            # --- outside of the Flowfield: walk straight toward the player ---
             playerpos = VectorSprite.numbers[1].pos
             dx, dy = 0, 0
             if self.pos.x < playerpos.x:
-                dx = Viewer.tilesize
+                dx = Occupancy.grid
             elif self.pos.x > playerpos.x:
-                dx = - Viewer.tilesize
+                dx = - Occupancy.grid
             if self.pos.y < playerpos.y:
-                dy = -Viewer.tilesize
+                dy = -Occupancy.grid
             elif self.pos.y > playerpos.y:
-                dy = Viewer.tilesize
+                dy = Occupancy.grid
             return dx, -dy
 
     def ai(self):
-        playerpos = VectorSprite.numbers[1].pos
-        distance = (self.pos - playerpos ).length() // Viewer.tilesize
+        # --- steps to the player, walking around walls ---
+        distance = Flowfield.distance.get(self.tile, Flowfield.radius + 1)
         if distance < self.sniffrange:
             dx, dy = self.run_to_player() # -dy 
         else:
             dx, dy = random.choice([(0,0), (0,0), (0,0),
-                                    (-Viewer.tilesize, -Viewer.tilesize),
-                                    (-Viewer.tilesize, 0),
-                                    (-Viewer.tilesize, Viewer.tilesize),
-                                    (0, -Viewer.tilesize),
-                                    (0, Viewer.tilesize),
-                                    (Viewer.tilesize, -Viewer.tilesize),
-                                    (Viewer.tilesize, 0),
-                                    (Viewer.tilesize, Viewer.tilesize)])
+                                    (-Occupancy.grid, -Occupancy.grid),
+                                    (-Occupancy.grid, 0),
+                                    (-Occupancy.grid, Occupancy.grid),
+                                    (0, -Occupancy.grid),
+                                    (0, Occupancy.grid),
+                                    (Occupancy.grid, -Occupancy.grid),
+                                    (Occupancy.grid, 0),
+                                    (Occupancy.grid, Occupancy.grid)])
         self.dx, self.dy = dx, dy
         # --- checking Patrol / SleepState
         if self.state.__str__()=="PatrolState":
@@ -731,6 +1139,7 @@ class Monster(VectorSprite):
                 self.image = self.image0
             else:
                 self.image = self.image1
+        self.mask = get_mask(self.image)
         VectorSprite.update(self, seconds)
         
     #def moving_animation(self, duration=0.1):
@@ -749,21 +1158,26 @@ class Monster(VectorSprite):
         
     
     def create_image(self):
-        self.image=Viewer.images[self.imagenames[0]]   
+        """the 4 pictures are shared by all monsters with the same imagenames
+           (see Assets.get), never draw on them"""
         # stand normal, look right + left     
-        self.image0 = self.image.copy()
-        self.image1 = pygame.transform.flip(self.image, True, False)
+        self.image0 = Assets.get(self.imagenames[0])
+        self.image1 = Assets.get(self.imagenames[0], flipx=True)
         # attack, look right + left
-        self.image2 = Viewer.images[self.imagenames[1]]
-        self.image3 = pygame.transform.flip(self.image2, True, False)
+        self.image2 = Assets.get(self.imagenames[1])
+        self.image3 = Assets.get(self.imagenames[1], flipx=True)
         # move, look right + left 
-        #print(Viewer.images)
-        # self.image4 = Viewer.images[self.imagenames[2]]
-        # self.image5 = pygame.transform.flip(self.image4, True, False)
+        # self.image4 = Assets.get(self.imagenames[2])
+        # self.image5 = Assets.get(self.imagenames[2], flipx=True)
+        self.image = self.image0
+        self.mask = get_mask(self.image)
         self.rect = self.image.get_rect()
 
 class Wizard(Monster):
     
+    occupant = "player"
+    bar = True
+    
     def _overwrite_parameters(self):
         self.lookright = True
         self.attacktime = 0
@@ -776,7 +1190,6 @@ class Wizard(Monster):
         self.dx, self.dy = 0, 0
         self.sniffrange = 5
         #print("ich bin wizard", self.number)
-        Bar(bossnumber=self.number)
         #Hitpointbar(bossnumber=self.number, kill_with_boss=True,
         #            sticky_with_boss=True, ydistance=0, width=50,
         #            always_create_image=True)
@@ -784,6 +1197,8 @@ class Wizard(Monster):
 
 class Lizard(Monster):
     
+    bar = True
+    
     def _overwrite_parameters(self):
         self.attack = 5
         self.defense = 2
@@ -794,7 +1209,6 @@ class Lizard(Monster):
         self.imagenames = ["reptile", "reptile-a"]
         self.dx, self.dy = 0, 0
         self.sniffrange = 5
-        Bar(bossnumber=self.number)
         self.tired = 0
         self.state = PatrolState()
         self.bounty = 1
@@ -804,6 +1218,8 @@ class Lizard(Monster):
     
 class Wolf(Monster):
     
+    bar = True
+    
     def _overwrite_parameters(self):
         self.lookright = True
         self.attacktime = 0
@@ -817,12 +1233,13 @@ class Wolf(Monster):
         self.sniffrange = 5
         self.state = PatrolState()
         self.tired = 0
-        Bar(bossnumber=self.number)
         self.bounty = 4
 
   
 class Boss(Monster):
     
+   bar = True
+    
    def _overwrite_parameters(self):
         self.lookright = True
         self.attacktime = 0
@@ -836,13 +1253,14 @@ class Boss(Monster):
         self.sniffrange = 15
         self.state = BerserkState()
         self.tired = 0
-        Bar(bossnumber=self.number)
         self.bounty = 20
 
 
 
 class Chest(Monster):
     
+    occupant = "chest"
+    
     def _overwrite_parameters(self):
         self.lookright = True
         self.attacktime = 0
@@ -857,6 +1275,8 @@ class Chest(Monster):
         self.state = NoneState()
         self.tired = 500
         #Bar(bossnumber=self.number)
+    
+    def _spawn_parameters(self):
         self.bounty = random.randint(1,20)
     
     def ai(self):
@@ -866,6 +1286,8 @@ class Chest(Monster):
    
 class Shop(VectorSprite):
     
+    occupant = "shop"
+    
     def create_image(self):
         self.color = (0,0,222)
         self.image = pygame.Surface((50,50))
@@ -922,7 +1344,7 @@ class Cannon(VectorSprite):
                    angle=self.angle, move = v+self.move, color=self.color)
     
     def create_image(self):
-        self.image=Viewer.images["cannon"]
+        self.image = Assets.get("cannon")
         
         self.image0 = self.image.copy()
        # self.image0.set_colorkey((0,0,0))
@@ -952,6 +1374,7 @@ class Cannon(VectorSprite):
         if self.selected:
             self.move = dist
             self.set_angle(angle)
+            self.image = self.image.copy() # the rotated image is shared by Rotcache
             pygame.draw.rect(self.image, (0,200,0), (0,0,self.rect.width, self.rect.height),1)
 
 
@@ -993,6 +1416,8 @@ class Extra(VectorSprite):
    
 class Rocket(VectorSprite):
     
+    images = {} # { color: Surface }, shared by all rockets of this color (see Rotcache)
+    
     def _overwrite_parameters(self):
         self._layer = 9
         self.kill_on_edge = True
@@ -1018,13 +1443,16 @@ class Rocket(VectorSprite):
         VectorSprite.kill(self)
     
     def create_image(self):
-        self.image = pygame.Surface((30,10))
-        pygame.draw.circle(self.image, (1,1,1), (25,5), 5)
-        pygame.draw.rect(self.image, self.color, (0,0,25,10))
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
+        color = tuple(self.color)
+        if color not in Rocket.images:
+            image = pygame.Surface((30,10))
+            pygame.draw.circle(image, (1,1,1), (25,5), 5)
+            pygame.draw.rect(image, color, (0,0,25,10))
+            image.set_colorkey((0,0,0))
+            Rocket.images[color] = image.convert_alpha()
+        self.image = Rocket.images[color]
         self.rect= self.image.get_rect()
-        self.image0 = self.image.copy()                          
+        self.image0 = self.image
     
 
 class Bullet(VectorSprite):
@@ -1046,6 +1474,64 @@ class Bullet(VectorSprite):
         self.image0 = self.image.copy()                          
     
 
+class Palette():
+    """pre-painted images for sparks and gems. For each (shape, color, delta) a set of
+       Palette.variants images with randomized colors (see randomize_color) is
+       painted once. A new particle only picks one of those shared images"""
+    
+    variants = 8 # color variants per set
+    maxsets = 256 # the least recently used set is painted over if there are more
+    book = collections.OrderedDict() # { (shape, color, delta): index in sets }, least recently used first
+    sets = [] # [ [Surface, Surface, ...], ... ]
+    
+    @staticmethod
+    def paint(shape, color):
+        """returns a new 10x10 image of a spark or gem, looking right"""
+        image = pygame.Surface((10,10))
+        if shape == "spark":
+            pygame.draw.line(image, color, (10,5), (5,5), 3)
+            pygame.draw.line(image, color, (5,5), (2,5), 1)
+        elif shape == "gem":
+            pygame.draw.polygon(image, color,
+                 [(5,0), (10,3), (10,7), (5,10), (0,7), (0,3)])
+        image.set_colorkey((0,0,0))
+        return image.convert_alpha()
+    
+    @staticmethod
+    def get(shape, color, delta):
+        """returns the index of the set for shape, color=(r,g,b) and delta=(dr,dg,db).
+           Similar colors (rounded down to a multiple of 8) share one set"""
+        color = tuple(int(c) // 8 * 8 for c in color)
+        key = (shape, color, delta)
+        if key in Palette.book:
+            Palette.book.move_to_end(key)
+            return Palette.book[key]
+        images = []
+        for v in range(Palette.variants):
+            c = tuple(randomize_color(color[i], delta[i]) for i in range(3))
+            images.append(Palette.paint(shape, c))
+        if len(Palette.sets) < Palette.maxsets:
+            index = len(Palette.sets)
+            Palette.sets.append(images)
+        else:
+            index = Palette.evict()
+            Palette.sets[index] = images
+        Palette.book[key] = index
+        return index
+    
+    @staticmethod
+    def pick(shape, color, delta):
+        """returns one of the shared images, do not draw on it"""
+        return random.choice(Palette.sets[Palette.get(shape, color, delta)])
+    
+    @staticmethod
+    def evict():
+        """forget the least recently used set and return its index for a new set.
+           Gems and Sparks keep their own reference to the image, so they do not change"""
+        key, index = Palette.book.popitem(last=False)
+        return index
+
+
 class Gem(VectorSprite):
 
     def _overwrite_parameters(self):
@@ -1053,16 +1539,10 @@ class Gem(VectorSprite):
         self.kill_on_edge = True
 
     def create_image(self):
-        r = randomize_color(self.red, self.red_delta)
-        g = randomize_color(self.green, self.green_delta)
-        b = randomize_color(self.blue, self.blue_delta)
-        self.image = pygame.Surface((10,10)) 
-        pygame.draw.polygon(self.image, (r,g,b),
-             [(5,0), (10,3), (10,7), (5,10), (0,7), (0,3)])
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
+        self.image = Palette.pick("gem", (self.red, self.green, self.blue),
+                                  (self.red_delta, self.green_delta, self.blue_delta))
         self.rect= self.image.get_rect()
-        self.image0 = self.image.copy()                          
+        self.image0 = self.image
         
     
 
@@ -1073,19 +1553,10 @@ class Spark(VectorSprite):
         self.kill_on_edge = True
         
     def create_image(self):
-        #r,g,b = self.color
-        r = randomize_color(self.red, self.red_delta)
-        g = randomize_color(self.green, self.green_delta)
-        b = randomize_color(self.blue, self.blue_delta)
-        self.image = pygame.Surface((10,10))
-        pygame.draw.line(self.image, (r,g,b), 
-                         (10,5), (5,5), 3)
-        pygame.draw.line(self.image, (r,g,b),
-                          (5,5), (2,5), 1)
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
+        self.image = Palette.pick("spark", (self.red, self.green, self.blue),
+                                  (self.red_delta, self.green_delta, self.blue_delta))
         self.rect= self.image.get_rect()
-        self.image0 = self.image.copy()                          
+        self.image0 = self.image
         
 
 class Explosion():
@@ -1125,13 +1596,134 @@ class Explosion():
     
     
 
+class Hudtext(pygame.sprite.DirtySprite):
+    """text (or log panel) in screen coordinates on top of all sprites, for
+       Viewer.draw_dirty. LayeredDirty paints it again only if the image has changed
+       or a sprite below has changed"""
+    
+    def __init__(self, x, y, layer=100):
+        pygame.sprite.DirtySprite.__init__(self)
+        self._layer = layer
+        self.image = pygame.Surface((0,0))
+        self.rect = self.image.get_rect(topleft=(x, y))
+    
+    def set_image(self, image):
+        """image should be shared (Textcache, Log.render), so an unchanged text is the same Surface"""
+        if image is not self.image:
+            self.image = image
+            self.rect = image.get_rect(topleft=self.rect.topleft)
+            self.dirty = 1
+
+
+class Logentry():
+    """one entry of the Log as a record: what happened (event), who (class names) and the dice.
+       The text is only formatted when the entry is shown (text) or exported (export)"""
+    
+    colors = {"strikes at": (0,255,0), "strikes back": (0,200,0), "strike": (255,255,255)}
+    
+    def __init__(self, event, attacker, defender, attack=0, defense=0, dice=(), damage=0):
+        self.event = event # "strikes at", "strikes back" or "strike"
+        self.attacker = attacker # class name
+        self.defender = defender # class name
+        self.attack = attack
+        self.defense = defense
+        self.dice = dice # (d1, d2, d3, d4): 2d6 for attack and 2d6 for defense
+        self.damage = damage
+    
+    def color(self):
+        return Logentry.colors[self.event]
+    
+    def text(self):
+        if self.event == "strikes at":
+            return "{} strikes at {}".format(self.attacker, self.defender)
+        if self.event == "strikes back":
+            return "{} strikes back against {}".format(self.attacker, self.defender)
+        d1, d2, d3, d4 = self.dice
+        text = "hit!" if self.damage > 0 else "fail..."
+        text += " attack+2d6 = {} + {} + {} = {} Vs. defense+2d6 = {} + {} + {} = {}".format(
+                self.attack, d1, d2, self.attack+d1+d2, self.defense, d3, d4, self.defense + d3+d4)
+        if self.damage > 0:
+            text += "  DAMAGE {} HP".format(self.damage)
+        return text
+    
+    def export(self):
+        """machine readable version of the entry, one line of json"""
+        return json.dumps({"event": self.event, "attacker": self.attacker, "defender": self.defender,
+                           "attack": self.attack, "defense": self.defense, "dice": list(self.dice),
+                           "damage": self.damage})
+
+
+class Log():
+    """message log of the game. Stores the last maxlines Logentry records in a
+       ring buffer, older entries are written (as json lines) to the file spillfile
+       (if not None) before they are forgotten. The visible lines are painted on a cached panel
+       surface that only changes when a new entry arrives or the number of 
+       visible lines changes, so showing the log costs one blit per frame"""
+    
+    def __init__(self, maxlines=1000, spillfile=None):
+        self.lines = collections.deque(maxlen=maxlines)
+        self.spillfile = spillfile
+        self.spill = None # open file, see append
+        self.version = 0 # increases with every new entry
+        self.panel = None
+        self.panelkey = None # (version, loglines, width, height) of the painted panel
+    
+    def append(self, entry):
+        if self.spillfile is not None and len(self.lines) == self.lines.maxlen:
+            if self.spill is None:
+                self.spill = open(self.spillfile, "a")
+            self.spill.write(self.lines[0].export() + "\n")
+        self.lines.append(entry)
+        self.version += 1
+    
+    def export(self, filename):
+        """write all stored entries as json lines into the file filename"""
+        with open(filename, "w") as f:
+            for entry in self.lines:
+                f.write(entry.export() + "\n")
+    
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+    
+    def __len__(self):
+        return len(self.lines)
+    
+    def __getitem__(self, i):
+        return self.lines[i]
+    
+    def __iter__(self):
+        return iter(self.lines)
+    
+    def render(self, loglines, fontsize=12, linesize=10):
+        """returns the panel with the last loglines entries. The panel is shared and only
+           painted again when the log (or the screen size) has changed"""
+        key = (self.version, loglines, Viewer.width, Viewer.height)
+        if key != self.panelkey:
+            self.panel = pygame.Surface((Viewer.width - Viewer.width // 2, loglines * linesize),
+                                        pygame.SRCALPHA)
+            for i in range(-loglines, 0):
+                if -i > len(self.lines):
+                    continue
+                entry = self.lines[i]
+                write(self.panel, entry.text(), x=0, y=(loglines + i) * linesize, color=entry.color(), fontsize=fontsize)
+            self.panelkey = key
+        return self.panel
+    
+    def draw(self, screen, loglines, fontsize=12, linesize=10):
+        """blit the last loglines entries to the bottom half of the screen (right side)"""
+        if loglines <= 0:
+            return
+        screen.blit(self.render(loglines, fontsize, linesize), (Viewer.width // 2, Viewer.height - loglines * linesize))
+
+
 class Viewer(object):
     width = 0
     dungeon = []
-    log = []
+    log = Log(maxlines=1000) # set Viewer.log.spillfile to a filename to keep older entries
     gold = 0
     height = 0
-    images = {}
     sounds = {}
     #inventory = []
     history = ["main"]
@@ -1141,6 +1733,7 @@ class Viewer(object):
     maxx = 100
     maxy = 100
     fullscreen = False
+    dirtyrects = False # paint and update only the changed parts of the screen (see draw_dirty)
     gamemenu =  {"main":            ["resume", "use", "equip", "settings", "credits", "quit" ],
             #main
             # cheatmenu 
@@ -1152,11 +1745,12 @@ class Viewer(object):
             "tile size":       ["back", "25x25", "50x50", "75x75", "100x100"],
             "max. tiles x":    ["back", "50", "100", "150", "200", "250"],
             "max. tiles y":    ["back", "50", "100", "150", "200", "250"],
-            "video":           ["back", "resolution", "fullscreen"],
+            "video":           ["back", "resolution", "fullscreen", "dirty rects"],
             #difficulty
            
     
-            "fullscreen":      ["back", "true", "false"]
+            "fullscreen":      ["back", "true", "false"],
+            "dirty rects":     ["back", "true", "false"]
             }
     
     shopmenu = {"main": [ "resume", "earn money", "buy", "sell", "show inventory"],
@@ -1255,47 +1849,12 @@ class Viewer(object):
     
   
     
-    def load_sprites(self):
-            """ all sprites that can rotate MUST look to the right. Edit Image files manually if necessary!"""
-            print("loading sprites from 'data' folder....")
-            #Viewer.images["catapult1"]= pygame.image.load(
-            #     os.path.join("data", "catapultC1.png")).convert_alpha()
-            
-            ##self.create_selected("catapult1")
-            
-            #Viewer.images["cannon"] = pygame.image.load(os.path.join("data", "cannon.png"))
-            Viewer.images["wizard"] = pygame.image.load(os.path.join(
-                                      "data", "arch-mage.png"))
-            Viewer.images["reptile"] = pygame.image.load(os.path.join(
-                                       "data", "fighter.png"))
-            Viewer.images["wizard-a"] = pygame.image.load(os.path.join(
-                                      "data", "arch-mage-attack.png"))
-            Viewer.images["reptile-a"] = pygame.image.load(os.path.join(
-                                       "data", "fighter-attack.png"))
-            Viewer.images["wolf"] = pygame.image.load(os.path.join(
-                                        "data", "wolf.png"))
-            Viewer.images["wolf-a"] = pygame.image.load(os.path.join(
-                                        "data","wolf-attack.png"))
-            Viewer.images["chest"] = pygame.image.load(os.path.join(
-                                        "data", "chest-plain-closed.png"))
-            Viewer.images["chest-a"] = pygame.image.load(os.path.join(
-                                        "data", "chest-plain-open.png"))
-            # --- boss images (scaled to be bigger) ---
-            #Viewer.images["bosswolf"] = pygame.image.load(os.path.join(
-            #                            "data", "bosswolf.png"))
-            i = pygame.image.load(os.path.join(
-                                        "data", "wolf.png"))
-            Viewer.images["bosswolf"] = pygame.transform.scale(i, (150,150))
-            i = pygame.image.load(os.path.join(
-                                        "data","wolf-attack.png"))                                                    
-            Viewer.images["bosswolf-a"] = pygame.transform.scale(i, (150,150))                                                    
-                                    
-            
-     
     def prepare_sprites(self):
         """painting on the surface and create sprites"""
-        self.load_sprites()
-        self.allgroup =  pygame.sprite.LayeredUpdates() # for drawing
+        self.allgroup =  pygame.sprite.LayeredDirty() # for drawing
+        self.dirtykey = None # see draw_dirty
+        self.hud = {}
+        self.gridkey = None # see grid_layer
         self.flytextgroup = pygame.sprite.Group()
         #self.mousegroup = pygame.sprite.Group()
         
@@ -1334,6 +1893,11 @@ class Viewer(object):
     def menu_run(self):
         running = True
         pygame.mouse.set_visible(False)
+        # --- paint everything again after the menu, texts of draw_dirty are not needed here ---
+        self.dirtykey = None
+        self.allgroup.clear(self.screen, None)
+        for h in self.hud.values():
+            h.kill()
         
         
         while running:
@@ -1496,6 +2060,11 @@ class Viewer(object):
                                 Viewer.fullscreen = False
                                 self.set_resolution()
                         
+                        elif Viewer.name == "dirty rects":
+                            if text in ("true", "false"):
+                                Viewer.dirtyrects = text == "true"
+                                print("setting dirty rects to", text)
+                        
             # ------delete everything on screen-------
             self.screen.blit(self.background, (0, 0))
             
@@ -1506,6 +2075,7 @@ class Viewer(object):
             self.allgroup.update(seconds)
 
             # ----------- clear, draw , update, flip -----------------
+            self.allgroup.repaint_rect(self.screen.get_rect())
             self.allgroup.draw(self.screen)
             # --- paint gold ---
             write(self.screen, text="You have {} gold.".format(Viewer.gold),x=20, y=20, color=(200,200,0))
@@ -1536,16 +2106,64 @@ class Viewer(object):
         return True 
     
     
-    def paint_dungeon(self):
-        # --- paint a 50 x 50 grid ----
-        c = (128,128,128) # grey
-        for x in range(0, Viewer.width+Viewer.tilesize, Viewer.tilesize):
-            pygame.draw.line(self.screen, c, (x-Viewer.tilesize//2,0), (x-Viewer.tilesize//2, Viewer.height))
-        for y in range(0, Viewer.height+Viewer.tilesize, Viewer.tilesize):
-            pygame.draw.line(self.screen, c, (0, y-Viewer.tilesize//2), (Viewer.width, y-Viewer.tilesize//2))
-        
+    def grid_layer(self):
+        """returns the background with the grid painted on it. It is painted only once
+           and again only if the tile size or the resolution (background) has changed"""
+        key = (Viewer.tilesize, self.background)
+        if key != self.gridkey:
+            self.gridlayer = self.background.copy()
+            # --- paint a 50 x 50 grid ----
+            c = (128,128,128) # grey
+            for x in range(0, Viewer.width+Viewer.tilesize, Viewer.tilesize):
+                pygame.draw.line(self.gridlayer, c, (x-Viewer.tilesize//2,0), (x-Viewer.tilesize//2, Viewer.height))
+            for y in range(0, Viewer.height+Viewer.tilesize, Viewer.tilesize):
+                pygame.draw.line(self.gridlayer, c, (0, y-Viewer.tilesize//2), (Viewer.width, y-Viewer.tilesize//2))
+            self.gridkey = key
+        return self.gridlayer
+    
+    def paint_dungeon(self, surface=None):
+        """blit background and grid (one blit, see grid_layer)"""
+        if surface is None:
+            surface = self.screen
+        surface.blit(self.grid_layer(), (0, 0))
+    
+    def draw_dirty(self, loglines):
+        """paints only sprites that have changed (or were covered by changed sprites)
+           and updates only those parts of the display. The texts are Hudtext sprites.
+           A frame where nothing moves costs (almost) nothing"""
+        key = (Viewer.width, Viewer.height, Viewer.tilesize)
+        if key != self.dirtykey:
+            # --- first frame (or after menu): paint everything ---
+            self.dungeonbackground = self.grid_layer()
+            self.hud = {"fps":  Hudtext(Viewer.width - 200, 10, 100),
+                        "gold": Hudtext(Viewer.width - 300, 10, 101),
+                        "log":  Hudtext(Viewer.width // 2, Viewer.height - loglines * 10, 102)}
+            self.allgroup.add(*self.hud.values())
+            self.allgroup.repaint_rect(self.screen.get_rect())
+            self.dirtykey = key
+        self.hud["fps"].set_image(Textcache.render("FPS: {:8.3}".format(self.clock.get_fps()),
+                                                   (0,255,0), 'mono', 12, bold=True))
+        self.hud["gold"].set_image(Textcache.render("gold: {}".format(VectorSprite.numbers[1].gold),
+                                                    (255,255,0), 'mono', 24, bold=True))
+        self.hud["log"].set_image(Viewer.log.render(loglines))
+        # --- PAGEUP / PAGEDOWN change the height of the log panel, its bottom stays at the screen edge ---
+        if self.hud["log"].rect.bottomleft != (Viewer.width // 2, Viewer.height):
+            self.hud["log"].rect.bottomleft = (Viewer.width // 2, Viewer.height)
+            self.hud["log"].dirty = 1
+        # --- LayeredDirty does not merge the rects of killed sprites. Where they overlap,
+        #     transparent sprites (Flytext) would be painted twice and look darker ---
+        merged = []
+        for r in self.allgroup.lostsprites:
+            r = pygame.Rect(r)
+            i = r.collidelist(merged)
+            while i > -1:
+                r.union_ip(merged.pop(i))
+                i = r.collidelist(merged)
+            merged.append(r)
+        self.allgroup.lostsprites[:] = merged
+        rects = self.allgroup.draw(self.screen, self.dungeonbackground)
+        pygame.display.update(rects)
     
-  
     def create_level(self):
         # --- kill old walls ----
         for w in self.wallgroup:
@@ -1553,6 +2171,9 @@ class Viewer(object):
         # --- kill old shop ----
         for s in self.shopgroup:
             s.kill()
+        # --- the new level starts with an empty Occupancy index, only the player stays ---
+        Occupancy.clear()
+        Occupancy.add(self.player1)
         # --- outer wall ---
         for x in range(0, Viewer.width, 50):
             WallBorder(pos=pygame.math.Vector2(x, 0))
@@ -1579,7 +2200,7 @@ class Viewer(object):
         for x in range(50, Viewer.width-50, 50):
             for y in range(50, Viewer.height-50, 50):
                 if random.random() < 0.05:
-                    Chest(pos=pygame.math.Vector2(x, -y))
+                    Prototypes.spawn(Chest, pos=pygame.math.Vector2(x, -y))
         
         # ---- create random enemies ------
         pool = ["wolf","wolf","wolf", "lizard"]
@@ -1591,9 +2212,9 @@ class Viewer(object):
                 if random.random() < 0.05:  # 5%
                     what = random.choice(pool)
                     if what=="wolf":
-                        Wolf(pos=pygame.math.Vector2(x,-y))
+                        Prototypes.spawn(Wolf, pos=pygame.math.Vector2(x,-y))
                     if what=="lizard":
-                        Lizard(pos=pygame.math.Vector2(x,-y))
+                        Prototypes.spawn(Lizard, pos=pygame.math.Vector2(x,-y))
         
         
         # --- no wall on players / enemies -----
@@ -1647,7 +2268,7 @@ class Viewer(object):
                         
                     # --- spawn a boss -----
                     if event.key == pygame.K_e:
-                        Boss(pos=pygame.math.Vector2(50,-50))
+                        Prototypes.spawn(Boss, pos=pygame.math.Vector2(50,-50))
                     # --- move player 1 (wizard) -----
                   
                     if event.key == pygame.K_UP:
@@ -1678,8 +2299,8 @@ class Viewer(object):
                         else:
                             x=-50
                         self.player1.attack_animation()
-                        Fireball(pos=pygame.math.Vector2(self.player1.pos.x, self.player1.pos.y),
-                                 move=pygame.math.Vector2(x, 0))
+                        Prototypes.spawn(Fireball, pos=pygame.math.Vector2(self.player1.pos.x, self.player1.pos.y),
+                                         move=pygame.math.Vector2(x, 0))
                         turn += 1
                     
                     if event.key == pygame.K_b:
@@ -1711,8 +2332,12 @@ class Viewer(object):
                         
             # ---- check wall for moving player 1
             if dx != 0 or dy != 0:
-                for w in self.wallgroup:
-                    if w.pos.x == self.player1.pos.x + dx and w.pos.y==self.player1.pos.y + dy:
+                target = Occupancy.tile(pygame.math.Vector2(self.player1.pos.x + dx,
+                                                            self.player1.pos.y + dy))
+                w = Occupancy.get("wall", target)
+                s = Occupancy.get("shop", target)
+                e = Occupancy.get("monster", target) or Occupancy.get("chest", target)
+                if w is not None:
                         self.player1.attack_animation()
                         w.crack()
                         w.hitpoints -= random.randint(1,10)
@@ -1725,11 +2350,8 @@ class Viewer(object):
                                 red=w.color[0], green=w.color[1], blue=w.color[2],
                                 minangle = angle-45, maxangle= angle+45)
                         dx , dy = 0, 0 # player must stop
-                        break
-                # ----- check enemy for moving player 1
-                for s in self.shopgroup:
-                    if (s.pos.x == self.player1.pos.x+dx and
-                        s.pos.y == self.player1.pos.y + dy):
+                # ----- check shop for moving player 1
+                elif s is not None:
                         dx, dy =0, 0
                         #self.player1.hitpoints += 10
                         
@@ -1742,10 +2364,8 @@ class Viewer(object):
                         running = self.menu_run() 
                         VectorSprite.numbers[1].gold = Viewer.gold
                         Viewer.menu = Viewer.gamemenu
-                for e in self.enemygroup:
-                    
-                    if e.pos.x == self.player1.pos.x + dx and e.pos.y==self.player1.pos.y + dy:
-                        
+                # ----- check enemy for moving player 1
+                elif e is not None:
                         ## fight
                         e.on_event("attacked")
                         e.tired -= 20 
@@ -1753,35 +2373,33 @@ class Viewer(object):
                         Explosion(posvector = pygame.math.Vector2(
                                 self.player1.pos.x + dx//2, self.player1.pos.y + dy//2))
                         dx , dy = 0, 0 # player must stop
-                        break
                 
                 # ---- move the player -----
                 self.player1.pos.x += dx
                 self.player1.pos.y += dy
+                Occupancy.moved(self.player1)
                         
             # ------------ move the (hostile) monsters -----
             if turn > oldturn:
+                Flowfield.update(self.player1.tile)
                 for e in self.enemygroup:
                     e.ai()
-                    # wall ?
-                    for w in self.wallgroup:
-                       if e.pos.x + e.dx == w.pos.x and e.pos.y + e.dy == w.pos.y:
+                    if e.dx == 0 and e.dy == 0:
+                        continue
+                    target = Occupancy.tile(pygame.math.Vector2(e.pos.x + e.dx, e.pos.y + e.dy))
+                    # wall or other (hostile) monster ?
+                    if (Occupancy.get("wall", target) is not None or
+                        Occupancy.get("monster", target) is not None or
+                        Occupancy.get("chest", target) is not None):
                            e.dx, e.dy = 0, 0
-                           break
-                    # other (hostile) monster ?
-                    for e2 in self.enemygroup:
-                        if e2.number == e.number:
-                            continue
-                        if e.pos.x + e.dx == e2.pos.x and e.pos.y + e.dy == e2.pos.y:
-                            e.dx, e.dy = 0, 0
-                            break 
-                        # player ?
-                    if e.pos.x + e.dx == self.player1.pos.x and e.pos.y + e.dy == self.player1.pos.y:
+                    # player ?
+                    elif Occupancy.get("player", target) is not None:
                         fight(e, self.player1)
                         e.dx, e.dy = 0, 0
                     # ---- move the monster ------
                     e.pos.x += e.dx
                     e.pos.y += e.dy
+                    Occupancy.moved(e)
                         
                     
             # ---------------        
@@ -1830,8 +2448,8 @@ class Viewer(object):
                 
               
             # =========== delete everything on screen ==============
-            self.screen.blit(self.background, (0, 0))
-            self.paint_dungeon()
+            if not Viewer.dirtyrects:
+                self.paint_dungeon()
             # ----trails for rockets------
             #for r in self.rocketgroup:
             #    if len(r.trail) > 1:
@@ -1845,30 +2463,28 @@ class Viewer(object):
                        
             # write text below sprites
            
-            # ----- collision detection between fireball and wall---
-            for w in self.wallgroup:
-                if w.pos == pygame.math.Vector2(0,0):
-                    continue # unnötige Borderwall
-                crashgroup=pygame.sprite.spritecollide(w,
-                           self.missilegroup, False, 
-                           pygame.sprite.collide_rect)
-                for o in crashgroup:
-                    Explosion(posvector = o.pos)
-                    o.kill()
+            # ----- collision detection between fireball and wall, only walls near the fireball ---
+            for o in self.missilegroup:
+                for w in Occupancy.near(("wall",), o.rect):
+                    if w.pos == pygame.math.Vector2(0,0):
+                        continue # unnötige Borderwall
+                    if o.rect.colliderect(w.rect):
+                        Explosion(posvector = o.pos)
+                        o.kill()
+                        break
             
-            # ----- collision detection between fireball and wolf---
-            for e in self.enemygroup:
-                crashgroup=pygame.sprite.spritecollide(e,
-                           self.missilegroup, False, 
-                           pygame.sprite.collide_mask)
-                for o in crashgroup:
-                     #if o.boss.number == p.number:
-                     #    continue
-            #        #elastic_collision(o, p)
-                     Explosion(posvector=o.pos)
-                     o.kill()
-                     e.hitpoints -= 1
-            #        # p.hitpoints -= 1
+            # ----- collision detection between fireball and wolf, only monsters near the fireball ---
+            for o in self.missilegroup:
+                for e in Occupancy.near(("monster", "chest"), o.rect):
+                    if pygame.sprite.collide_mask(e, o):
+                        #if o.boss.number == p.number:
+                        #    continue
+                        #elastic_collision(o, p)
+                        Explosion(posvector=o.pos)
+                        o.kill()
+                        e.hitpoints -= 1
+                        # p.hitpoints -= 1
+                        break
             
                 
             
@@ -1888,7 +2504,7 @@ class Viewer(object):
                 # -- time for a boss ? ----
                 if not self.boss_done:
                     for y in range(self.level):
-                        Boss(pos=pygame.math.Vector2(150,-100-50 * y))
+                        Prototypes.spawn(Boss, pos=pygame.math.Vector2(150,-100-50 * y))
                     self.boss_done = True
                 else:
                     Flytext(pos=pygame.math.Vector2(Viewer.width//2, -Viewer.height),
@@ -1900,33 +2516,33 @@ class Viewer(object):
                     self.boss_done = False
 
             # ----------- clear, draw , update, flip -----------------
-            self.allgroup.draw(self.screen)
-            #print(self.allgroup)
-            # ----- FPS -----
-            write(self.screen, "FPS: {:8.3}".format(
-                self.clock.get_fps() ), x=Viewer.width-200, y=10, color=(0,255,0), fontsize=12)
-            
-            write(self.screen, "gold: {}".format(
-                  VectorSprite.numbers[1].gold), 
-                  x=Viewer.width - 300, y=10, 
-                  color=(255,255,0),
-                  fontsize = 24)
-            
-            # ----- log ------
-            for i in range(-loglines, 0):
-                try:
-                    textcolor, line = Viewer.log[i]
-                except:
-                    continue
-                write(self.screen, line, x=Viewer.width // 2, y=Viewer.height + i*10, color=textcolor, fontsize=12)
-            
-           
+            if Viewer.dirtyrects:
+                self.draw_dirty(loglines)
+            else:
+                self.allgroup.repaint_rect(self.screen.get_rect())
+                self.allgroup.draw(self.screen)
+                #print(self.allgroup)
+                # ----- FPS -----
+                write(self.screen, "FPS: {:8.3}".format(
+                    self.clock.get_fps() ), x=Viewer.width-200, y=10, color=(0,255,0), fontsize=12)
                 
-            # -------- next frame -------------
-            pygame.display.flip()
+                write(self.screen, "gold: {}".format(
+                      VectorSprite.numbers[1].gold), 
+                      x=Viewer.width - 300, y=10, 
+                      color=(255,255,0),
+                      fontsize = 24)
+                
+                # ----- log ------
+                Viewer.log.draw(self.screen, loglines)
+                    
+                # -------- next frame -------------
+                pygame.display.flip()
         #-----------------------------------------------------
-        for line in Viewer.log:
-            print(line[1])
+        for entry in Viewer.log:
+            print(entry.text())
+        Viewer.log.close()
+        print(Assets.stats())
+        print(Prototypes.stats())
         pygame.mouse.set_visible(True)    
         pygame.quit()
 
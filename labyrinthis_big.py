@@ -10,6 +10,15 @@ idea: python3/pygame 2d vector dungeon crawl roguelike
 import pygame
 import random
 import os
+import collections
+import json
+import time
+import heapq
+import numpy
+
+# ---- text level: Viewer.level is a numpy uint8 array, code = position of the character in LEGEND ----
+LEGEND = ".#~$+"
+FLOOR, WALL, OUTERWALL, SHOP, CORRIDOR = range(len(LEGEND))
 
 def mouseVector():
     return pygame.math.Vector2(pygame.mouse.get_pos()[0],
@@ -21,12 +30,205 @@ def randomize_color(color, delta=50):
     color = max(0, color)
     return color
 
+def crackline():
+    """random crack from a border point toward the middle of a 50x50 wall.
+       returns x1, y1, x2, y2, thickness"""
+    # border point
+    border = random.choice(("n","s","w","e"))
+    if border == "n":
+        x1 = random.randint(0, 50)
+        y1 = 0
+        x2 = random.randint(20,30)
+        y2 = random.randint(15,25)
+    if border == "s":
+        x1 = random.randint(0, 50)
+        y1 = 50
+        x2 = random.randint(20,30)
+        y2 = random.randint(25,35)
+    if border == "w":
+        x1 = 0
+        y1 = random.randint(0, 50)
+        x2 = random.randint(15,25)
+        y2 = random.randint(20,30)
+    if border == "e":
+        x1 = 50
+        y1 = random.randint(0, 50)
+        x2 = random.randint(25,35)
+        y2 = random.randint(20,30)
+    thick = random.randint(1,3)
+    return x1, y1, x2, y2, thick
+
+fonts = {} # { (name, size, bold): pygame font }, see get_font
+
+def get_font(name=None, size=24, bold=False):
+    """returns a pygame font. SysFont is slow, so each (name, size, bold) is created
+       only once (when it is first needed) and then reused by write and make_text"""
+    key = (name, size, bold)
+    if key not in fonts:
+        fonts[key] = pygame.font.SysFont(name, size, bold=bold)
+    return fonts[key]
+
+masks = collections.OrderedDict() # { id(Surface): (Surface, Mask) }, see get_mask
+maxmasks = 512 # the least recently used masks are forgotten first
+
+def get_mask(image):
+    """returns the collision mask of image, for pygame.sprite.collide_mask. Images are
+       shared (Assets, Rotcache), so each mask is made only once. The image is kept in masks,
+       so its id can not be reused by another Surface"""
+    entry = masks.get(id(image))
+    if entry is None:
+        entry = (image, pygame.mask.from_surface(image))
+        masks[id(image)] = entry
+        if len(masks) > maxmasks:
+            masks.popitem(last=False)
+    else:
+        masks.move_to_end(id(image))
+    return entry[1]
+
+class Textcache():
+    """LRU cache of rendered text surfaces, used by write() and make_text().
+       Text that did not change since the last frame (gold, log lines, menu items)
+       costs only a blit. When the surfaces need more than Textcache.maxbytes,
+       the least recently used ones are forgotten"""
+    
+    book = collections.OrderedDict() # { (text, font, size, bold, color, antialias, alpha): Surface }
+    maxbytes = 4 * 1024 * 1024 # memory cap for all cached surfaces
+    bytes = 0
+    hits = 0
+    misses = 0
+    
+    @staticmethod
+    def render(text, color, fontname=None, size=24, bold=False, antialias=True, alpha=False):
+        """returns the rendered text as (shared!) Surface. Do not draw on it.
+           alpha=True converts the surface with convert_alpha()"""
+        key = (text, fontname, size, bold, tuple(color), antialias, alpha)
+        surface = Textcache.book.get(key)
+        if surface is not None:
+            Textcache.hits += 1
+            Textcache.book.move_to_end(key)
+            return surface
+        Textcache.misses += 1
+        surface = get_font(fontname, size, bold).render(text, antialias, color)
+        if alpha:
+            surface = surface.convert_alpha()
+        Textcache.book[key] = surface
+        Textcache.bytes += surface.get_pitch() * surface.get_height()
+        while Textcache.bytes > Textcache.maxbytes and len(Textcache.book) > 1:
+            _, old = Textcache.book.popitem(last=False)
+            Textcache.bytes -= old.get_pitch() * old.get_height()
+        return surface
+
+
+class Rotcache():
+    """LRU cache of rotated images, used by VectorSprite.rotate and set_angle.
+       The angle is rounded to a multiple of Rotcache.step degree, so all sprites
+       with the same source image (image0) share the rotated images. When the images
+       need more than Rotcache.maxbytes, the least recently used ones are forgotten"""
+    
+    book = collections.OrderedDict() # { (id of source, degree): (source, rotated Surface) }
+    step = 3 # degree, smaller is smoother but needs more memory
+    maxbytes = 8 * 1024 * 1024 # memory cap for all cached surfaces
+    bytes = 0
+    hits = 0
+    misses = 0
+    
+    @staticmethod
+    def rotate(image, angle):
+        """returns image rotated by angle (rounded to Rotcache.step) as shared Surface.
+           Do not draw on it"""
+        steps = round(angle / Rotcache.step) % round(360 / Rotcache.step)
+        if steps == 0:
+            return image
+        # the source is kept in the cache, so its id can not be reused by another Surface.
+        # The key is the rounded angle in degree, so it stays right if Rotcache.step changes
+        key = (id(image), steps * Rotcache.step)
+        entry = Rotcache.book.get(key)
+        if entry is not None:
+            Rotcache.hits += 1
+            Rotcache.book.move_to_end(key)
+            return entry[1]
+        Rotcache.misses += 1
+        surface = pygame.transform.rotate(image, steps * Rotcache.step)
+        Rotcache.book[key] = (image, surface)
+        Rotcache.bytes += surface.get_pitch() * surface.get_height()
+        while Rotcache.bytes > Rotcache.maxbytes and len(Rotcache.book) > 1:
+            _, (_, old) = Rotcache.book.popitem(last=False)
+            Rotcache.bytes -= old.get_pitch() * old.get_height()
+        return surface
+
+
+class Assets():
+    """images from the 'data' folder. A picture is loaded when it is first needed
+       (get), converted once to the pixel format of the display and then shared by
+       all sprites. Derived pictures (scaled, flipped) are also made only once.
+       all sprites that can rotate MUST look to the right. Edit Image files manually if necessary!"""
+    
+    folder = "data"
+    # name: (filename, size or None for original size)
+    files = {"wizard":     ("arch-mage.png", None),
+             "wizard-a":   ("arch-mage-attack.png", None),
+             "reptile":    ("fighter.png", None),
+             "reptile-a":  ("fighter-attack.png", None),
+             "wolf":       ("wolf.png", None),
+             "wolf-a":     ("wolf-attack.png", None),
+             "chest":      ("chest-plain-closed.png", None),
+             "chest-a":    ("chest-plain-open.png", None),
+             "cannon":     ("cannon.png", None),
+             # --- boss images (scaled to be bigger) ---
+             "bosswolf":   ("wolf.png", (150,150)),
+             "bosswolf-a": ("wolf-attack.png", (150,150)),
+            }
+    images = {}   # filename: converted Surface, as loaded from disk
+    variants = {} # (name, size, flipx, flipy): Surface
+    loads = 0     # number of files read from disk
+    seconds = 0   # time spent reading and converting files
+    hits = 0
+    misses = 0
+    
+    @staticmethod
+    def load(filename):
+        """reads filename from the data folder (only once) and converts it for fast blitting"""
+        if filename not in Assets.images:
+            start = time.perf_counter()
+            surface = pygame.image.load(os.path.join(Assets.folder, filename))
+            if pygame.display.get_surface() is not None:
+                surface = surface.convert_alpha()
+            Assets.images[filename] = surface
+            Assets.loads += 1
+            Assets.seconds += time.perf_counter() - start
+        return Assets.images[filename]
+    
+    @staticmethod
+    def get(name, size=None, flipx=False, flipy=False):
+        """returns the shared Surface for name (see Assets.files), optionally
+           scaled to size=(width, height) and/or flipped. Do not draw on it"""
+        key = (name, size, flipx, flipy)
+        if key in Assets.variants:
+            Assets.hits += 1
+            return Assets.variants[key]
+        Assets.misses += 1
+        filename, filesize = Assets.files.get(name, (name, None))
+        if size is None:
+            size = filesize
+        surface = Assets.load(filename)
+        if size is not None and size != surface.get_size():
+            surface = pygame.transform.scale(surface, size)
+        if flipx or flipy:
+            surface = pygame.transform.flip(surface, flipx, flipy)
+        Assets.variants[key] = surface
+        return surface
+    
+    @staticmethod
+    def stats():
+        """returns a string with load statistics"""
+        return "assets: {} files loaded in {:.3f} s, {} variants, {} hits, {} misses".format(
+                Assets.loads, Assets.seconds, len(Assets.variants), Assets.hits, Assets.misses)
+
+
 def make_text(msg="pygame is cool", fontcolor=(255, 0, 255), fontsize=42, font=None):
-    """returns pygame surface with text. You still need to blit the surface."""
-    myfont = pygame.font.SysFont(font, fontsize)
-    mytext = myfont.render(msg, True, fontcolor)
-    mytext = mytext.convert_alpha()
-    return mytext
+    """returns pygame surface with text. You still need to blit the surface.
+       The surface comes from the Textcache and is shared, do not draw on it"""
+    return Textcache.render(msg, fontcolor, font, fontsize, alpha=True)
 
 def write(background, text="bla", pos=None, color=(0,0,0),
           fontsize=None, center=False, x=None, y=None):
@@ -40,9 +242,8 @@ def write(background, text="bla", pos=None, color=(0,0,0),
             y = -pos.y
         if fontsize is None:
             fontsize = 24
-        font = pygame.font.SysFont('mono', fontsize, bold=True)
-        fw, fh = font.size(text)
-        surface = font.render(text, True, color)
+        surface = Textcache.render(text, color, 'mono', fontsize, bold=True)
+        fw, fh = surface.get_size()
         if center: # center text around x,y
             background.blit(surface, (x-fw//2, y-fh//2))
         else:      # topleft corner is x,y
@@ -83,10 +284,10 @@ def elastic_collision(sprite1, sprite2):
 
 
 def fight(attacker, defender):
-    Viewer.log.append([(0,255,0), "{} strikes at {}".format(attacker.__class__.__name__, defender.__class__.__name__)])
+    Viewer.log.append(Logentry("strikes at", attacker.__class__.__name__, defender.__class__.__name__))
     strike(attacker, defender)
     if defender.hitpoints > 0:
-        Viewer.log.append([(0,200,0),"{} strikes back against {}".format(defender.__class__.__name__, attacker.__class__.__name__)])
+        Viewer.log.append(Logentry("strikes back", defender.__class__.__name__, attacker.__class__.__name__))
         strike(defender, attacker)
         
 def strike(attacker, defender):
@@ -113,13 +314,9 @@ def strike(attacker, defender):
             move = m,
             color = (200,0,0) if damage > 0 else (20,20,20), max_age=2,
             fontsize=60)
-    text = "hit!" if damage > 0 else "fail..."
-    text += " attack+2d6 = {} + {} + {} = {} Vs. defense+2d6 = {} + {} + {} = {}".format(
-            attacker.attack, d1, d2, attacker.attack+d1+d2, defender.defense, d3, d4, defender.defense + d3+d4)
-    if damage > 0:
-        text += "  DAMAGE {} HP".format(damage)
     defender.hitpoints -= damage
-    Viewer.log.append([(255,255,255), text])
+    Viewer.log.append(Logentry("strike", attacker.__class__.__name__, defender.__class__.__name__,
+                               attacker.attack, defender.defense, (d1, d2, d3, d4), damage))
                 
                 
     
@@ -184,65 +381,961 @@ class Room():
     number = 0
     book = {} # dict for all rooms, key is the room number, value is the room instance
     
-    def __init__(self, z=0, xmin=0, ymin=0, xmax=100, ymax=100, maxwidth=15, maxheight=10, minheight=3, minwidth=3):
+    def __init__(self, z=0, xmin=0, ymin=0, xmax=100, ymax=100, maxwidth=15, maxheight=10, minheight=3, minwidth=3, rect=None):
+        """tries up to 1000 random places inside xmin, ymin, xmax, ymax for a new room.
+           if rect (x1, y1, x2, y2) is given, the room is created exactly there without testing"""
         #self.number = Room.number
         #Room.book[self.number] = self
         #Room.number += 1
         number = Room.number
+        if rect is not None:
+            self.place(*rect, z=z)
+            return
         
         for v in range(1000):
-            print("trying to create room number ", self.number, "attempt ",v)
+            if Viewer.verbose:
+                print("trying to create room number ", self.number, "attempt ",v)
             x1 = random.randint(xmin, xmax)
             y1 = random.randint(ymin, ymax)
             x2 = x1 + random.randint(minwidth, maxwidth)
             y2 = y1 + random.randint(minheight, maxheight)
             if x2 > xmax or y2 > ymax:
                 continue # out of dungeon limits
-            print(x1,y1,x2,y2)
+            if Viewer.verbose:
+                print(x1,y1,x2,y2)
             # -- check for intersection with other rooms ---
-            ok = True
             for r in Room.book.values():
                 if r.number == number:
                     continue
                 if r.z != z:
                     continue 
-                print("testing with", r.x1, r.y1, r.x2, r.y2)
-                ## I must test EACH border piece of one rect if it is inside the other rect
-                for y in range(y1, y2+1):
-                    for x in range(x1, x2+1):
-                        if y1 < y < y2 and x1 < x < x2:
-                            continue
-                        if r.x1 <= x <= r.x2 and r.y1 <= y <= r.y2:
-                            ok = False
-                if not ok:
+                # two rectangles overlap unless one is completely left/right/above/below the other
+                if x1 <= r.x2 and r.x1 <= x2 and y1 <= r.y2 and r.y1 <= y2:
+                    if Viewer.verbose:
+                        print("overlapping with", r.x1, r.y1, r.x2, r.y2)
                     break 
             else:
                 # good room
-                print("room created with:", x1,y1,x2,y2)
-                self.number = Room.number
-                Room.book[self.number] = self
-                Room.number += 1
-                self.x1, self.y1, self.x2, self.y2 = x1,y1,x2,y2
-                self.z = z
+                self.place(x1, y1, x2, y2, z=z)
                 break
         else:
             print("unable to create (another) room...")
+    
+    def place(self, x1, y1, x2, y2, z=0):
+        """give the room its number and put it into Room.book"""
+        if Viewer.verbose:
+            print("room created with:", x1,y1,x2,y2)
+        self.number = Room.number
+        Room.book[self.number] = self
+        Room.number += 1
+        self.x1, self.y1, self.x2, self.y2 = x1,y1,x2,y2
+        self.z = z
+    
+    @staticmethod
+    def bsp(rooms, z=0, xmin=0, ymin=0, xmax=100, ymax=100, maxwidth=15, maxheight=10, minheight=3, minwidth=3):
+        """binary space partition: cuts the area xmin, ymin, xmax, ymax into (up to) rooms
+           pieces and creates one room inside each piece. Never fails and needs linear time.
+           Neighbouring pieces get following room numbers, so corridors stay short"""
+        leaves = []
+        todo = [((xmin, ymin, xmax, ymax), rooms)]
+        while todo:
+            (x1, y1, x2, y2), n = todo.pop()
+            w = x2 - x1 + 1 # leaf size in tiles
+            h = y2 - y1 + 1
+            # --- a room needs minwidth+1 x minheight+1 tiles (floor plus wall) ---
+            canx = w >= 2 * (minwidth + 1)
+            cany = h >= 2 * (minheight + 1)
+            if n <= 1 or not (canx or cany):
+                leaves.append((x1, y1, x2, y2))
+                continue
+            n1 = n // 2
+            n2 = n - n1
+            if canx and (w >= h or not cany):
+                # --- cut vertical ---
+                cut = round(w * n1 / n) + random.randint(-2, 2)
+                cut = max(minwidth + 1, min(w - (minwidth + 1), cut))
+                first, second = (x1, y1, x1 + cut - 1, y2), (x1 + cut, y1, x2, y2)
+            else:
+                # --- cut horizontal ---
+                cut = round(h * n1 / n) + random.randint(-2, 2)
+                cut = max(minheight + 1, min(h - (minheight + 1), cut))
+                first, second = (x1, y1, x2, y1 + cut - 1), (x1, y1 + cut, x2, y2)
+            # --- stack: the first half is processed (and numbered) first ---
+            todo.append((second, n2))
+            todo.append((first, n1))
+        for (x1, y1, x2, y2) in leaves:
+            if x2 - x1 < minwidth or y2 - y1 < minheight:
+                continue # too small, can only happen if the whole area is too small
+            width = random.randint(minwidth, min(maxwidth, x2 - x1))
+            height = random.randint(minheight, min(maxheight, y2 - y1))
+            rx = random.randint(x1, x2 - width)
+            ry = random.randint(y1, y2 - height)
+            Room(z=z, rect=(rx, ry, rx + width, ry + height))
+    
+    @staticmethod
+    def find(tile):
+        """returns the room that contains the floor tile (x,y) or None"""
+        for r in Room.book.values():
+            if r.x1 <= tile[0] < r.x2 and r.y1 <= tile[1] < r.y2:
+                return r
+        return None
             
             
         
 
 
-class VectorSprite(pygame.sprite.Sprite):
-    """base class for sprites. this class inherits from pygames sprite class"""
+class Occupancy():
+    """tile-keyed index of the sprites that can block a tile:
+       shops, chests, monsters and the player (walls are tiles of the Tilemap).
+       key is the tile (x, y), y axis goes positive down (like Room).
+       Sprites register themselves in VectorSprite.__init__ and unregister in kill(),
+       moving sprites must call Occupancy.moved(sprite) after changing their pos.
+       Turn resolution in Viewer.run asks the index instead of scanning sprite groups.
+       Tiles depend on Viewer.tilesize, Viewer.set_tilesize moves all sprites
+       so that they keep their tile"""
+    
+    book = {} # { kind: { (x,y): [sprite, ...] } }
+    biggest = 0 # biggest width or height of a registered sprite, see near
+    
+    @staticmethod
+    def tile(pos):
+        """converts a pygame position (y negative) into a tile (x, y)"""
+        return (int(round(pos.x / Viewer.tilesize)), int(round(-pos.y / Viewer.tilesize)))
+    
+    @staticmethod
+    def add(sprite):
+        sprite.tile = Occupancy.tile(sprite.pos)
+        Occupancy.book.setdefault(sprite.occupant, {}).setdefault(sprite.tile, []).append(sprite)
+        Occupancy.biggest = max(Occupancy.biggest, sprite.rect.width, sprite.rect.height)
+    
+    @staticmethod
+    def remove(sprite):
+        tiles = Occupancy.book.get(sprite.occupant, {})
+        here = tiles.get(sprite.tile, [])
+        if sprite in here:
+            here.remove(sprite)
+            if len(here) == 0:
+                del tiles[sprite.tile]
+    
+    @staticmethod
+    def moved(sprite):
+        """call this after changing the pos of a registered sprite"""
+        if Occupancy.tile(sprite.pos) != sprite.tile:
+            Occupancy.remove(sprite)
+            Occupancy.add(sprite)
+    
+    @staticmethod
+    def get(kind, tile):
+        """returns the first sprite of kind ("shop", "chest", "monster", "player")
+           standing on tile or None"""
+        here = Occupancy.book.get(kind, {}).get(tile)
+        if here:
+            return here[0]
+        return None
+    
+    @staticmethod
+    def near(kinds, rect):
+        """returns all sprites of kinds (e.g. ("monster", "chest")) that could overlap rect 
+           (pygame rect like sprite.rect). Only the tiles around rect are looked at,
+           so the cost does not grow with the number of sprites in the level"""
+        ts = Viewer.tilesize
+        # --- a sprite can reach biggest/2 pixel from the center of its tile, 
+        #     plus one tile if it has moved (Occupancy.moved) but its rect is not yet updated ---
+        r = rect.inflate(Occupancy.biggest + 2 * ts, Occupancy.biggest + 2 * ts)
+        found = []
+        for kind in kinds:
+            tiles = Occupancy.book.get(kind, {})
+            for y in range(int(round(r.top / ts)), int(round(r.bottom / ts)) + 1):
+                for x in range(int(round(r.left / ts)), int(round(r.right / ts)) + 1):
+                    found.extend(tiles.get((x, y), ()))
+        return found
+    
+    @staticmethod
+    def rebuild():
+        """registers all sprites again, call this after Viewer.tilesize has changed"""
+        sprites = [s for tiles in Occupancy.book.values() for here in tiles.values() for s in here]
+        Occupancy.book = {}
+        for sprite in sprites:
+            Occupancy.add(sprite)
+    
+    @staticmethod
+    def clear():
+        Occupancy.book = {}
+
+
+class Flowfield():
+    """distance map toward the player, shared by all Monsters.
+       Once per turn a breadth-first search runs over the tile grid, starting at the
+       player's tile and flowing around walls. Each Monster then finds its next step
+       with a single neighbour lookup instead of searching on its own.
+       The field is only recalculated if the player moved or a wall was built/destroyed"""
+    
+    distance = {} # { (x,y): steps to the player }
+    origin = None # tile of the player when the field was calculated
+    version = None # Pathfinder.version when the field was calculated
+    radius = 30 # in tiles. Monsters further away than that are not in the field
+    neighbours = ((-1,-1), (0,-1), (1,-1), (-1,0), (1,0), (-1,1), (0,1), (1,1))
+    
+    @staticmethod
+    def update(playertile):
+        """recalculate the field if necessary. Call this once per turn"""
+        if playertile == Flowfield.origin and Pathfinder.version == Flowfield.version:
+            return # nothing has changed, keep the old field
+        level = Pathfinder.level
+        px, py = playertile
+        distance = {playertile: 0}
+        todo = collections.deque([playertile])
+        while todo:
+            tile = todo.popleft()
+            steps = distance[tile] + 1
+            for (dx, dy) in Flowfield.neighbours:
+                x, y = tile[0] + dx, tile[1] + dy
+                if abs(x - px) > Flowfield.radius or abs(y - py) > Flowfield.radius:
+                    continue
+                if (x, y) in distance:
+                    continue
+                if level is not None and not Pathfinder.passable((x, y)):
+                    continue
+                distance[(x, y)] = steps
+                todo.append((x, y))
+        Flowfield.distance = distance
+        Flowfield.origin = playertile
+        Flowfield.version = Pathfinder.version
+    
+    @staticmethod
+    def next_step(tile):
+        """returns the neighbour tile that is closest to the player and not occupied 
+           by another monster or chest, or None if there is no better tile"""
+        best = None
+        beststeps = Flowfield.distance.get(tile)
+        if beststeps is None:
+            return None
+        for (dx, dy) in Flowfield.neighbours:
+            t = (tile[0] + dx, tile[1] + dy)
+            steps = Flowfield.distance.get(t)
+            if steps is None or steps >= beststeps:
+                continue
+            if Occupancy.get("monster", t) is not None or Occupancy.get("chest", t) is not None:
+                continue
+            best, beststeps = t, steps
+        return best
+
+
+class Pathfinder():
+    """A* pathfinding over the text level from Viewer.create_textlevel,
+       for Monsters with goals other than the player (patrol routes, returning home).
+       Computed paths are kept in a LRU cache, key is (start, goal, map version, regions).
+       Each tile on a path only remembers the path and its place on it (onpath),
+       so a path is stored once. The map version increases whenever a wall is built
+       or destroyed, and the cache is emptied at the same moment"""
+    
+    level = None # the text level (numpy uint8 array [y, x]), set by Viewer.create_textlevel
+    version = 0 
+    cache = collections.OrderedDict() # { (start, goal, version, regions): [tile, tile, ...] or None }
+    onpath = {} # { (tile, goal, version, regions): (key of the path in cache, index of the next tile) }
+    maxcache = 512 # number of paths to remember
+    maxnodes = 5000 # give up searching after visiting that many tiles
+    blocking = (WALL, OUTERWALL) # tile codes in the text level that can not be walked through
+    hits = 0
+    misses = 0
+    
+    @staticmethod
+    def passable(tile):
+        x, y = tile
+        height, width = Pathfinder.level.shape
+        if y < 0 or y >= height or x < 0 or x >= width:
+            return False
+        return Pathfinder.level.item(y, x) not in Pathfinder.blocking
+    
+    @staticmethod
+    def set_tile(tile, code):
+        """change one tile of the text level (wall built or destroyed) and invalidate cached paths"""
+        if Pathfinder.level is None:
+            return
+        x, y = tile
+        height, width = Pathfinder.level.shape
+        if not (0 <= y < height and 0 <= x < width):
+            return
+        if Pathfinder.level.item(y, x) == code:
+            return
+        Pathfinder.level[y, x] = code
+        current = Roomgraph.version == Pathfinder.version
+        Pathfinder.new_level(Pathfinder.level)
+        if current:
+            Roomgraph.update(tile) # only the regions around tile, not the whole map
+    
+    @staticmethod
+    def new_level(level):
+        Pathfinder.level = level
+        Pathfinder.version += 1
+        Pathfinder.cache.clear()
+        Pathfinder.onpath = {}
+    
+    @staticmethod
+    def find_path(start, goal, regions=None):
+        """returns a list of tiles from start (excluded) to goal (included), 
+           [] if start is goal, or None if there is no way.
+           regions: tuple of Roomgraph regions the path may not leave, None for everywhere"""
+        key = (start, goal, Pathfinder.version, regions)
+        place = Pathfinder.onpath.get(key)
+        if place is not None:
+            # --- start is on a known path to goal ---
+            Pathfinder.hits += 1
+            Pathfinder.cache.move_to_end(place[0])
+            return Pathfinder.cache[place[0]][place[1]:]
+        if key in Pathfinder.cache:
+            Pathfinder.hits += 1 # known to have no way
+            Pathfinder.cache.move_to_end(key)
+            return None
+        Pathfinder.misses += 1
+        path = Pathfinder._astar(start, goal, regions)
+        Pathfinder.cache[key] = path
+        if path is not None:
+            # --- a monster following this path will ask again from every tile on it ---
+            for i, tile in enumerate([start] + path[:-1]):
+                Pathfinder.onpath[(tile,) + key[1:]] = (key, i)
+        while len(Pathfinder.cache) > Pathfinder.maxcache:
+            Pathfinder._forget(*Pathfinder.cache.popitem(last=False)) # throw away the oldest path
+        return path
+    
+    @staticmethod
+    def _forget(key, path):
+        """removes the onpath entries of a path that was thrown out of the cache"""
+        if path is None:
+            return
+        for tile in [key[0]] + path[:-1]:
+            tilekey = (tile,) + key[1:]
+            if Pathfinder.onpath.get(tilekey, (None,))[0] == key: # not taken over by a newer path
+                del Pathfinder.onpath[tilekey]
+    
+    @staticmethod
+    def _astar(start, goal, regions=None):
+        if start == goal:
+            return []
+        if not Pathfinder.passable(goal):
+            return None
+        gx, gy = goal
+        camefrom = {start: None}
+        cost = {start: 0}
+        todo = [(0, start)]
+        visited = 0
+        while todo:
+            _, tile = heapq.heappop(todo)
+            if tile == goal:
+                path = []
+                while tile != start:
+                    path.append(tile)
+                    tile = camefrom[tile]
+                path.reverse()
+                return path
+            visited += 1
+            if visited > Pathfinder.maxnodes:
+                return None
+            steps = cost[tile] + 1
+            for (dx, dy) in Flowfield.neighbours:
+                t = (tile[0] + dx, tile[1] + dy)
+                if t in cost and cost[t] <= steps:
+                    continue
+                if not Pathfinder.passable(t):
+                    continue
+                if regions is not None and Roomgraph.region.get(t) not in regions:
+                    continue
+                cost[t] = steps
+                camefrom[t] = tile
+                # diagonal steps cost the same as straight steps, so the chebyshev distance is exact without walls
+                heapq.heappush(todo, (steps + max(abs(gx - t[0]), abs(gy - t[1])), t))
+        return None
+
+
+class Roomgraph():
+    """hierarchical navigation (HPA* like) on top of Room.book.
+       Every passable tile of the text level belongs to a region: a room keeps its
+       Room number, connected corridor tiles outside of rooms get numbers after the rooms.
+       Neighbouring regions are connected by a portal (a pair of touching tiles).
+       Far away goals are planned region by region over this small graph, the tile-level
+       A* of Pathfinder only has to find the way to the next portal inside the current region.
+       The graph is built (lazy) for each new level, a single changed tile (Pathfinder.set_tile)
+       only updates the regions around it"""
+    
+    region = {} # { (x,y): region number }
+    members = {} # { region number: set of tiles }
+    links = {} # { region: { neighbour region: set of (tile in region, tile in neighbour) } }
+    rooms = 0 # region numbers below rooms are Rooms, the others are corridors
+    count = 0 # next free region number
+    portals = {} # { region: { neighbour region: (tile in region, tile in neighbour) } }
+    routes = {} # { (from region, to region): next region }
+    version = None # Pathfinder.version when the graph was built
+    
+    @staticmethod
+    def build():
+        region = {}
+        passable = numpy.isin(Pathfinder.level, Pathfinder.blocking, invert=True)
+        # --- rooms ---
+        for r in Room.book.values():
+            for y, x in (numpy.argwhere(passable[r.y1:r.y2, r.x1:r.x2]) + (r.y1, r.x1)).tolist():
+                region.setdefault((x, y), r.number)
+        # --- corridors: flood fill everything passable that is not in a room ---
+        number = len(Room.book)
+        for y, x in numpy.argwhere(passable).tolist():
+            if (x, y) in region:
+                continue
+            region[(x, y)] = number
+            todo = [(x, y)]
+            while todo:
+                tile = todo.pop()
+                for (dx, dy) in Flowfield.neighbours:
+                    t = (tile[0] + dx, tile[1] + dy)
+                    if t in region or not Pathfinder.passable(t):
+                        continue
+                    region[t] = number
+                    todo.append(t)
+            number += 1
+        # --- portals between touching regions ---
+        links = {}
+        portals = {}
+        for tile, a in region.items():
+            for t in Roomgraph.around(tile):
+                b = region.get(t)
+                if b is None or b == a:
+                    continue
+                links.setdefault(a, {}).setdefault(b, set()).add((tile, t))
+                portals.setdefault(a, {}).setdefault(b, (tile, t))
+        members = {}
+        for tile, a in region.items():
+            members.setdefault(a, set()).add(tile)
+        Roomgraph.region = region
+        Roomgraph.members = members
+        Roomgraph.rooms = len(Room.book)
+        Roomgraph.count = number
+        Roomgraph.links = links
+        Roomgraph.portals = portals
+        Roomgraph.routes = {}
+        Roomgraph.version = Pathfinder.version
+        if Viewer.verbose:
+            print("roomgraph: {} regions, {} portals".format(number, sum(len(p) for p in portals.values())))
+    
+    @staticmethod
+    def around(tile):
+        return [(tile[0] + dx, tile[1] + dy) for (dx, dy) in Flowfield.neighbours]
+    
+    @staticmethod
+    def _link(tile):
+        """add the pairs of touching tiles between tile and other regions"""
+        a = Roomgraph.region[tile]
+        for t in Roomgraph.around(tile):
+            b = Roomgraph.region.get(t)
+            if b is None or b == a:
+                continue
+            for (x, y, pair) in ((a, b, (tile, t)), (b, a, (t, tile))):
+                Roomgraph.links.setdefault(x, {}).setdefault(y, set()).add(pair)
+                Roomgraph.portals.setdefault(x, {}).setdefault(y, pair)
+    
+    @staticmethod
+    def _unlink(tile):
+        """forget the pairs of touching tiles between tile and other regions"""
+        a = Roomgraph.region[tile]
+        for t in Roomgraph.around(tile):
+            b = Roomgraph.region.get(t)
+            if b is None or b == a:
+                continue
+            for (x, y, pair) in ((a, b, (tile, t)), (b, a, (t, tile))):
+                pairs = Roomgraph.links[x][y]
+                pairs.discard(pair)
+                if len(pairs) == 0:
+                    del Roomgraph.links[x][y]
+                    del Roomgraph.portals[x][y]
+                elif Roomgraph.portals[x][y] == pair:
+                    Roomgraph.portals[x][y] = next(iter(pairs))
+    
+    @staticmethod
+    def _relabel(tiles, a):
+        """move tiles (a set) into region a"""
+        for tile in tiles:
+            b = Roomgraph.region[tile]
+            Roomgraph._unlink(tile)
+            Roomgraph.members[b].discard(tile)
+            Roomgraph.region[tile] = a
+            Roomgraph._link(tile)
+        Roomgraph.members.setdefault(a, set()).update(tiles)
+    
+    @staticmethod
+    def _pieces(starts, tiles):
+        """returns the pieces (sets) of the set tiles that are cut off from its biggest piece.
+           One flood runs from each start tile, side by side, floods that meet become one.
+           The last running flood is never walked to its end, so the cost depends
+           on the small pieces only, not on the size of the whole region"""
+        owner = {} # { tile: flood number }
+        floods = {} # { flood number: [found tiles, todo] }
+        for number, start in enumerate(starts):
+            if start not in owner:
+                owner[start] = number
+                floods[number] = [{start}, [start]]
+        while sum(1 for f in floods.values() if f[1]) > 1:
+            for number in list(floods):
+                if number not in floods or not floods[number][1]:
+                    continue
+                found, todo = floods[number]
+                tile = todo.pop()
+                for t in Roomgraph.around(tile):
+                    if t not in tiles:
+                        continue
+                    other = owner.get(t)
+                    if other is None:
+                        owner[t] = number
+                        found.add(t)
+                        todo.append(t)
+                    elif other != number:
+                        # --- two floods met: the smaller one joins the bigger one ---
+                        big, small = sorted((number, other), key=lambda n: len(floods[n][0]))[::-1]
+                        for x in floods[small][0]:
+                            owner[x] = big
+                        floods[big][0] |= floods[small][0]
+                        floods[big][1] += floods[small][1] + [tile] # look at tile again
+                        del floods[small]
+                        break
+        pieces = sorted((f[0] for f in floods.values()), key=len)
+        if any(f[1] for f in floods.values()):
+            return [f[0] for f in floods.values() if not f[1]] # the running flood is the big piece
+        return pieces[:-1]
+    
+    @staticmethod
+    def update(tile):
+        """tile was changed by Pathfinder.set_tile: give it a region or take it away,
+           split or merge the corridor regions around it and update their portals.
+           Gives the same regions as build, but only the smaller regions around tile are walked"""
+        region = Roomgraph.region
+        members = Roomgraph.members
+        if not Pathfinder.passable(tile):
+            # --- new wall: remove tile, a corridor may fall apart in pieces ---
+            a = region.get(tile)
+            if a is not None:
+                Roomgraph._unlink(tile)
+                del region[tile]
+                members[a].discard(tile)
+                if a >= Roomgraph.rooms:
+                    starts = [t for t in Roomgraph.around(tile) if region.get(t) == a]
+                    for piece in Roomgraph._pieces(starts, members[a]):
+                        Roomgraph._relabel(piece, Roomgraph.count)
+                        Roomgraph.count += 1
+                    if len(members[a]) == 0:
+                        del members[a]
+        elif tile not in region:
+            # --- wall destroyed: tile joins its room or the corridors around it ---
+            room = Room.find(tile)
+            corridors = {region[t] for t in Roomgraph.around(tile) if region.get(t, -1) >= Roomgraph.rooms}
+            if room is not None:
+                a = room.number
+            elif corridors:
+                a = max(corridors, key=lambda c: len(members[c])) # the smaller ones are renamed
+                for b in corridors - {a}:
+                    Roomgraph._relabel(set(members[b]), a)
+                    del members[b]
+            else:
+                a = Roomgraph.count
+                Roomgraph.count += 1
+            region[tile] = a
+            members.setdefault(a, set()).add(tile)
+            Roomgraph._link(tile)
+        Roomgraph.routes = {}
+        Roomgraph.version = Pathfinder.version
+    
+    @staticmethod
+    def next_region(a, b):
+        """first region to visit on the way from region a to region b (breadth-first over regions)"""
+        key = (a, b)
+        if key in Roomgraph.routes:
+            return Roomgraph.routes[key]
+        camefrom = {a: None}
+        todo = collections.deque([a])
+        hop = None
+        while todo:
+            r = todo.popleft()
+            if r == b:
+                while camefrom[r] != a:
+                    r = camefrom[r]
+                hop = r
+                break
+            for n in Roomgraph.portals.get(r, {}):
+                if n not in camefrom:
+                    camefrom[n] = r
+                    todo.append(n)
+        Roomgraph.routes[key] = hop
+        return hop
+    
+    @staticmethod
+    def find_path(start, goal):
+        """like Pathfinder.find_path, but for far goals only the path to the 
+           portal into the next region (without leaving the current region)"""
+        if Pathfinder.level is None:
+            return None
+        if Roomgraph.version != Pathfinder.version:
+            Roomgraph.build()
+        a = Roomgraph.region.get(start)
+        b = Roomgraph.region.get(goal)
+        if a is None or b is None or a == b:
+            return Pathfinder.find_path(start, goal)
+        hop = Roomgraph.next_region(a, b)
+        if hop is None:
+            return None # no way from region a to region b
+        path = Pathfinder.find_path(start, Roomgraph.portals[a][hop][1], (a, hop))
+        if path is None:
+            # --- region cut in pieces by a new wall? search without limits ---
+            path = Pathfinder.find_path(start, goal)
+        return path
+
+
+class Tilemap():
+    """draws the static terrain (walls and outer walls) of the text level.
+       Instead of one Wall sprite per tile, the level is cut into chunks of 
+       Tilemap.chunksize x Tilemap.chunksize tiles. Each chunk is painted once on its
+       own Surface (when it is first visible) and then blitted in one piece.
+       Only damaged walls (hitpoints, cracks) are remembered per tile"""
+    
+    chunksize = 8 # tiles
+    margin = 16 # painted chunks to keep besides the visible ones
+    maxchunks = 48 # painted chunks to keep, the least recently drawn chunk is forgotten first. Set by draw
+    chunks = collections.OrderedDict() # { (cx, cy): Surface }
+    tilesize = None # Viewer.tilesize when the chunks were painted
+    shade = None # numpy int array [y, x, 3], random color variation for each tile
+    colors = {WALL: (139, 105, 20), OUTERWALL: (255, 50, 50)}
+    hitpointsfull = {WALL: 1} # tile codes not in here are indestructible
+    hitpoints = {} # { (x,y): hitpoints left } only for damaged walls
+    cracks = {} # { (x,y): [(x1, y1, x2, y2, thickness), ...] }
+    version = 0 # changes when a tile is painted again
+    
+    @staticmethod
+    def new_level(level):
+        Tilemap.version += 1
+        Tilemap.chunks.clear()
+        Tilemap.hitpoints = {}
+        Tilemap.cracks = {}
+        Tilemap.shade = numpy.random.randint(-20, 21, (level.shape[0], level.shape[1], 3))
+    
+    @staticmethod
+    def inside(tile):
+        """True if tile (x,y) is inside the text level. numpy would wrap negative indexes
+           to the other side of the level, so always ask before reading Pathfinder.level"""
+        height, width = Pathfinder.level.shape
+        return 0 <= tile[0] < width and 0 <= tile[1] < height
+    
+    @staticmethod
+    def color(tile):
+        """color of the wall on tile (x,y), black outside of the level"""
+        if not Tilemap.inside(tile):
+            return (0, 0, 0)
+        x, y = tile
+        base = Tilemap.colors.get(Pathfinder.level.item(y, x), (0, 0, 0))
+        return tuple(min(255, max(0, base[i] + Tilemap.shade.item(y, x, i))) for i in range(3))
+    
+    @staticmethod
+    def hit(tile, damage):
+        """damage the wall on tile, destroy it if there are no hitpoints left"""
+        if not Tilemap.inside(tile):
+            return
+        x, y = tile
+        code = Pathfinder.level.item(y, x)
+        if code not in Tilemap.hitpointsfull:
+            return # hahahaha, indestructable
+        hp = Tilemap.hitpoints.get(tile, Tilemap.hitpointsfull[code]) - damage
+        if hp <= 0:
+            Tilemap.hitpoints.pop(tile, None)
+            Tilemap.cracks.pop(tile, None)
+            Pathfinder.set_tile(tile, FLOOR) # destroyed wall becomes floor
+        else:
+            Tilemap.hitpoints[tile] = hp
+            Tilemap.cracks.setdefault(tile, []).append(crackline())
+        Tilemap.repaint(tile)
+    
+    @staticmethod
+    def build(tile):
+        """new wall on tile (x,y), only on floor or corridor tiles (never on outer walls or the shop)"""
+        if not Tilemap.inside(tile) or Pathfinder.level.item(tile[1], tile[0]) not in (FLOOR, CORRIDOR):
+            return
+        Pathfinder.set_tile(tile, WALL)
+        Tilemap.repaint(tile)
+    
+    @staticmethod
+    def repaint(tile):
+        """paint one tile again, if its chunk is already painted"""
+        Tilemap.version += 1
+        chunk = Tilemap.chunks.get((tile[0] // Tilemap.chunksize, tile[1] // Tilemap.chunksize))
+        if chunk is not None:
+            Tilemap.paint_tile(chunk, tile)
+    
+    @staticmethod
+    def paint_tile(chunk, tile):
+        x, y = tile
+        ts = Viewer.tilesize
+        rect = pygame.Rect(x % Tilemap.chunksize * ts, y % Tilemap.chunksize * ts, ts, ts)
+        code = Pathfinder.level.item(y, x)
+        if code not in Tilemap.colors:
+            chunk.fill((0, 0, 0), rect) # transparent
+            return
+        chunk.fill(Tilemap.color(tile), rect)
+        pygame.draw.rect(chunk, (0, 0, 0), rect, 1)
+        if code == OUTERWALL:
+            pygame.draw.line(chunk, (0,200,0), rect.topleft, (rect.right-1, rect.bottom-1), 5)
+            pygame.draw.line(chunk, (0,200,0), (rect.left, rect.bottom-1), (rect.right-1, rect.top), 5)
+        for (x1, y1, x2, y2, thick) in Tilemap.cracks.get(tile, []):
+            f = ts / 50 # cracks are made for 50x50 tiles
+            pygame.draw.line(chunk, (0, 0, 0), (rect.x + x1 * f, rect.y + y1 * f),
+                             (rect.x + x2 * f, rect.y + y2 * f), thick)
+    
+    @staticmethod
+    def paint_chunk(cx, cy):
+        size = Tilemap.chunksize * Viewer.tilesize
+        chunk = pygame.Surface((size, size)).convert()
+        chunk.fill((0, 0, 0))
+        chunk.set_colorkey((0, 0, 0))
+        height, width = Pathfinder.level.shape
+        for y in range(cy * Tilemap.chunksize, min(height, (cy + 1) * Tilemap.chunksize)):
+            for x in range(cx * Tilemap.chunksize, min(width, (cx + 1) * Tilemap.chunksize)):
+                Tilemap.paint_tile(chunk, (x, y))
+        return chunk
+    
+    @staticmethod
+    def draw(screen):
+        """blit all chunks that are inside the Camera viewport"""
+        if Pathfinder.level is None:
+            return
+        if Tilemap.tilesize != Viewer.tilesize:
+            Tilemap.chunks.clear()
+            Tilemap.tilesize = Viewer.tilesize
+        ts = Viewer.tilesize
+        size = Tilemap.chunksize * ts
+        # --- all chunks that can be visible at once must fit, or the LRU forgets visible chunks ---
+        Tilemap.maxchunks = (Viewer.width // size + 2) * (Viewer.height // size + 2) + Tilemap.margin
+        height, width = Pathfinder.level.shape
+        view = Camera.viewport()
+        # --- tile (0,0) is centered on world pixel (0,0), so chunks start half a tile earlier ---
+        firstx = max(0, (view.left + ts // 2) // size)
+        firsty = max(0, (view.top + ts // 2) // size)
+        lastx = min((width - 1) // Tilemap.chunksize, (view.right + ts // 2) // size)
+        lasty = min((height - 1) // Tilemap.chunksize, (view.bottom + ts // 2) // size)
+        for cy in range(firsty, lasty + 1):
+            for cx in range(firstx, lastx + 1):
+                chunk = Tilemap.chunks.get((cx, cy))
+                if chunk is None:
+                    chunk = Tilemap.paint_chunk(cx, cy)
+                    Tilemap.chunks[(cx, cy)] = chunk
+                    if len(Tilemap.chunks) > Tilemap.maxchunks:
+                        Tilemap.chunks.popitem(last=False)
+                else:
+                    Tilemap.chunks.move_to_end((cx, cy))
+                screen.blit(chunk, Camera.to_screen(cx * size - ts // 2, cy * size - ts // 2))
+
+
+class Camera():
+    """scrolling view on the dungeon, follows the player.
+       Sprites (rect) and tiles live in world pixel coordinates, tile (0,0) is centered 
+       on world pixel (0,0). Camera.to_screen is the only place where world coordinates
+       become screen coordinates. Everything outside of the viewport is not blitted"""
+    
+    x = 0 # world pixel coordinates of the topleft corner of the screen
+    y = 0
+    drawn = {} # { sprite: screen rect }, painted by the last draw_dirty
+    background = None # background Surface of the last draw_dirty
+    
+    @staticmethod
+    def follow(sprite):
+        """center the camera on sprite, but do not scroll further than the level"""
+        ts = Viewer.tilesize
+        # --- smallest / biggest possible topleft corner ---
+        left, top = -ts // 2, -ts // 2
+        right = Viewer.maxx * ts - ts // 2 - Viewer.width
+        bottom = Viewer.maxy * ts - ts // 2 - Viewer.height
+        Camera.x = max(left, min(right, sprite.rect.centerx - Viewer.width // 2))
+        Camera.y = max(top, min(bottom, sprite.rect.centery - Viewer.height // 2))
+    
+    @staticmethod
+    def viewport():
+        """visible part of the world as pygame.Rect in world pixel coordinates"""
+        return pygame.Rect(Camera.x, Camera.y, Viewer.width, Viewer.height)
+    
+    @staticmethod
+    def to_screen(x, y):
+        return x - Camera.x, y - Camera.y
+    
+    @staticmethod
+    def to_world(x, y):
+        return x + Camera.x, y + Camera.y
+    
+    @staticmethod
+    def draw(group, screen):
+        """like group.draw(screen), but only for sprites inside the viewport"""
+        view = Camera.viewport()
+        for s in group.sprites(): # sprites() of LayeredUpdates is sorted by layer
+            if view.colliderect(s.rect):
+                screen.blit(s.image, Camera.to_screen(s.rect.x, s.rect.y))
+    
+    @staticmethod
+    def draw_dirty(group, screen, background, hud=()):
+        """like draw, but paints only sprites that have changed (dirty), were killed, or
+           are covered by those, and returns the changed screen rects for display.update.
+           background is the screen without sprites. If it is another Surface than in the last
+           call, everything is painted. hud are sprites in screen coordinates (Hudtext) on top"""
+        view = Camera.viewport()
+        sprites = [s for s in group.sprites() if view.colliderect(s.rect)]
+        new = {s: s.rect.move(-Camera.x, -Camera.y) for s in sprites}
+        for h in hud:
+            sprites.append(h)
+            new[h] = h.rect
+        old = Camera.drawn
+        if background is not Camera.background:
+            Camera.background = background
+            changed = [screen.get_rect()]
+        else:
+            changed = []
+            for s, r in new.items():
+                if s.dirty or s not in old:
+                    changed.append(r)
+                    if s in old:
+                        changed.append(old[s])
+            changed.extend(r for s, r in old.items() if s not in new)
+        # --- merge overlapping rects, or transparent sprites would be painted twice ---
+        rects = []
+        for r in changed:
+            r = pygame.Rect(r)
+            i = r.collidelist(rects)
+            while i > -1:
+                r.union_ip(rects.pop(i))
+                i = r.collidelist(rects)
+            rects.append(r)
+        for r in rects:
+            screen.blit(background, r, r)
+        for s in sprites:
+            r = new[s]
+            for i in r.collidelistall(rects):
+                clip = r.clip(rects[i])
+                screen.blit(s.image, clip, clip.move(-r.x, -r.y))
+            if s.dirty == 1:
+                s.dirty = 0
+        Camera.drawn = new
+        return rects
+
+
+class Prototypes():
+    """fully initialized default state of a sprite class (Monsters, Bar, Fireball).
+       The state is built once per class, spawn makes new sprites by copying it
+       instead of running _default_parameters, _overwrite_parameters and create_image again.
+       Values that must differ per sprite (random values, the hitpoint Bar) come from
+       _spawn_parameters. spawn only takes the keywords in Prototypes.keywords, which no
+       _overwrite_parameters changes, so spawn(cls, **kwargs) gives the same sprite as cls(**kwargs)"""
+    
+    keywords = ("pos", "move", "bossnumber")
+    states = {} # { class: { attribute: value } }
+    builds = 0
+    clones = 0
+    
+    @staticmethod
+    def build(cls):
+        """returns the default state of cls. The prototype is in no group, has no
+           number and is not in the Occupancy index"""
+        sprite = cls.__new__(cls)
+        sprite._default_parameters(pos=pygame.math.Vector2(0, 0))
+        sprite._overwrite_parameters()
+        sprite.create_image()
+        if sprite.angle != 0:
+            sprite.set_angle(sprite.angle)
+        state = dict(sprite.__dict__) # without pygame's Sprite values, spawn calls DirtySprite.__init__
+        Prototypes.states[cls] = state
+        Prototypes.builds += 1
+        return state
+    
+    @staticmethod
+    def spawn(cls, **kwargs):
+        """returns a new sprite of cls, like cls(**kwargs) but without making images"""
+        for key in kwargs:
+            if key not in Prototypes.keywords:
+                raise TypeError("Prototypes.spawn takes only {}, not {}: use {}(...) instead".format(
+                                ", ".join(Prototypes.keywords), key, cls.__name__))
+        state = Prototypes.states.get(cls)
+        if state is None:
+            state = Prototypes.build(cls)
+        sprite = cls.__new__(cls)
+        sprite.__dict__.update(state)
+        # --- mutable values are changed in place (pos += ...), every sprite needs its own ---
+        sprite.pos = pygame.math.Vector2(state["pos"])
+        sprite.move = pygame.math.Vector2(state["move"])
+        if "rect" in state:
+            sprite.rect = state["rect"].copy()
+        for key, arg in kwargs.items():
+            setattr(sprite, key, arg)
+        # --- the same steps as VectorSprite.__init__ ---
+        VectorSprite.number += 1
+        VectorSprite.numbers[VectorSprite.number] = sprite
+        sprite._spawn_parameters()
+        pygame.sprite.DirtySprite.__init__(sprite, sprite.groups)
+        sprite.number = VectorSprite.number
+        if "rect" not in state:
+            sprite.create_image() # the image depends on other sprites, like the boss of a Bar
+        sprite.distance_traveled = 0
+        sprite.tail = []
+        sprite.drawn = None
+        if sprite.occupant is not None:
+            Occupancy.add(sprite)
+        Prototypes.clones += 1
+        return sprite
+    
+    @staticmethod
+    def stats():
+        """returns a string with spawn statistics"""
+        return "prototypes: {} built, {} sprites spawned".format(Prototypes.builds, Prototypes.clones)
+
+
+class VectorSprite(pygame.sprite.DirtySprite):
+    """base class for sprites. this class inherits from pygames (dirty) sprite class.
+       dirty is set to 1 when image or position changed, see Viewer.dirtyrects"""
     number = 0
     numbers = {} # { number, Sprite }
+    occupant = None # kind of sprite in the Occupancy index, None for not blocking
+    hpversion = 0 # counts changes of hitpoints and hitpointsfull, see Bar
+    # --- defaults for missing keywords, a sprite stores only what differs ---
+    _layer = 4
+    _hitpoints = 100
+    _hitpointsfull = 100
+    static = False
+    selected = False
+    fontsize = 22
+    friction = 1.0 # no friction
+    radius = 5
+    width = 10 # radius * 2
+    height = 10
+    mass = 15
+    damage = 10
+    bounce_on_edge = False
+    kill_on_edge = False
+    angle = 0 # facing right?
+    max_age = None
+    max_distance = None
+    picture = None
+    bossnumber = None
+    kill_with_boss = False
+    sticky_with_boss = False
+    upkey = None
+    downkey = None
+    rightkey = None
+    leftkey = None
+    speed = 0
+    age = 0 # age in seconds
+    warp_on_edge = False
+    gravity = None
+    survive_north = False
+    survive_south = False
+    survive_west = False
+    survive_east = False
+    ydistance = 0
+    always_create_image = False
+    bounty = 0
+    gold = 0
 
     def __init__(self, **kwargs):
         self._default_parameters(**kwargs)
         VectorSprite.number += 1
         VectorSprite.numbers[self.number] = self
         self._overwrite_parameters()
-        pygame.sprite.Sprite.__init__(self, self.groups) #call parent class. NEVER FORGET !
+        self._spawn_parameters()
+        pygame.sprite.DirtySprite.__init__(self, self.groups) #call parent class. NEVER FORGET !
         self.number = VectorSprite.number # unique number for each sprite
 
         self.create_image()
@@ -251,103 +1344,58 @@ class VectorSprite(pygame.sprite.Sprite):
         if self.angle != 0:
             self.set_angle(self.angle)
         self.tail = [] 
+        self.drawn = None # (image, topleft) when dirty was last set
+        if self.occupant is not None:
+            Occupancy.add(self)
 
     def _overwrite_parameters(self):
         """change parameters before create_image is called""" 
         pass
 
-    def _default_parameters(self, **kwargs):    
-        """get unlimited named arguments and turn them into attributes
-           default values for missing keywords"""
+    def _spawn_parameters(self):
+        """values that can not be copied from a prototype (see Prototypes), 
+           like random values or other sprites. called after _overwrite_parameters"""
+        pass
 
-        for key, arg in kwargs.items():
-            setattr(self, key, arg)
-        if "layer" not in kwargs:
-            self._layer = 4
-        else:
-            self._layer = self.layer
-        if "static" not in kwargs:
-            self.static = False
-        if "selected" not in kwargs:
-            self.selected = False
+    @property
+    def hitpoints(self):
+        return self._hitpoints
+
+    @hitpoints.setter
+    def hitpoints(self, value):
+        self._hitpoints = value
+        self.hpversion += 1
+
+    @property
+    def hitpointsfull(self):
+        return self._hitpointsfull
+
+    @hitpointsfull.setter
+    def hitpointsfull(self, value):
+        self._hitpointsfull = value
+        self.hpversion += 1
+
+    def _default_parameters(self, **kwargs):
+        """get unlimited named arguments and turn them into attributes in one pass.
+           missing keywords fall back to the class attributes (see defaults above),
+           only the values that differ per sprite are created here"""
+        if "layer" in kwargs:
+            self._layer = kwargs.pop("layer")
+        kwargs.pop("hitpointsfull", None) # always a copy of hitpoints
+        hitpoints = kwargs.pop("hitpoints", None)
+        self.__dict__.update(kwargs)
+        if hitpoints is not None:
+            self.hitpoints = hitpoints
+            self.hitpointsfull = hitpoints # makes a copy
         if "pos" not in kwargs:
             self.pos = pygame.math.Vector2(random.randint(0, Viewer.width),-50)
         if "move" not in kwargs:
             self.move = pygame.math.Vector2(0,0)
-        if "fontsize" not in kwargs:
-            self.fontsize = 22
-        if "friction" not in kwargs:
-            self.friction = 1.0 # no friction
-        if "radius" not in kwargs:
-            self.radius = 5
-        if "width" not in kwargs:
-            self.width = self.radius * 2
-        if "height" not in kwargs:
-            self.height = self.radius * 2
-        
-        if "hitpoints" not in kwargs:
-            self.hitpoints = 100
-        self.hitpointsfull = self.hitpoints # makes a copy
-        if "mass" not in kwargs:
-            self.mass = 10
-        if "damage" not in kwargs:
-            self.damage = 10
-        if "bounce_on_edge" not in kwargs:
-            self.bounce_on_edge = False
-        if "kill_on_edge" not in kwargs:
-            self.kill_on_edge = False
-        if "angle" not in kwargs:
-            self.angle = 0 # facing right?
-        if "max_age" not in kwargs:
-            self.max_age = None
-        if "max_distance" not in kwargs:
-            self.max_distance = None
-        if "picture" not in kwargs:
-            self.picture = None
-        if "bossnumber" not in kwargs:
-            self.bossnumber = None
-        if "kill_with_boss" not in kwargs:
-            self.kill_with_boss = False
-        if "sticky_with_boss" not in kwargs:
-            self.sticky_with_boss = False
-        if "mass" not in kwargs:
-            self.mass = 15
-        if "upkey" not in kwargs:
-            self.upkey = None
-        if "downkey" not in kwargs:
-            self.downkey = None
-        if "rightkey" not in kwargs:
-            self.rightkey = None
-        if "leftkey" not in kwargs:
-            self.leftkey = None
-        if "speed" not in kwargs:
-            self.speed = None
-        if "age" not in kwargs:
-            self.age = 0 # age in seconds
-        if "warp_on_edge" not in kwargs:
-            self.warp_on_edge = False
-        if "gravity" not in kwargs:
-            self.gravity = None
-        if "survive_north" not in kwargs:
-            self.survive_north = False
-        if "survive_south" not in kwargs:
-            self.survive_south = False
-        if "survive_west" not in kwargs:
-            self.survive_west = False
-        if "survive_east" not in kwargs:
-            self.survive_east = False
-        if "speed" not in kwargs:
-            self.speed = 0
-        if "gravity" not in kwargs:
-            self.gravity = None
-        if "ydistance" not in kwargs:
-            self.ydistance = 0
-        if "always_create_image" not in kwargs:
-            self.always_create_image = False
-        if "bounty" not in kwargs:
-            self.bounty = 0
-        if "gold" not in kwargs:
-            self.gold = 0
+        if "radius" in kwargs:
+            if "width" not in kwargs:
+                self.width = self.radius * 2
+            if "height" not in kwargs:
+                self.height = self.radius * 2
         if "color" not in kwargs:
             self.color = (random.randint(0,255), random.randint(0,255), random.randint(0,255))
 
@@ -355,6 +1403,8 @@ class VectorSprite(pygame.sprite.Sprite):
         
         if self.number in self.numbers:
            del VectorSprite.numbers[self.number] # remove Sprite from numbers dict
+        if self.occupant is not None:
+            Occupancy.remove(self)
         
         if self.bounty > 0:
             VectorSprite.numbers[1].gold += self.bounty 
@@ -398,20 +1448,24 @@ class VectorSprite(pygame.sprite.Sprite):
         """rotates a sprite and changes it's angle by by_degree"""
         self.angle += by_degree
         oldcenter = self.rect.center
-        self.image = pygame.transform.rotate(self.image0, self.angle)
-        self.image.convert_alpha()
+        self.image = Rotcache.rotate(self.image0, self.angle)
+        if getattr(self, "mask", None) is not None: # sprites without mask get one from collide_mask
+            self.mask = get_mask(self.image)
         self.rect = self.image.get_rect()
         self.rect.center = oldcenter
+        self.dirty = 1
 
     def set_angle(self, degree):
         """rotates a sprite and changes it's angle to degree"""
         self.angle = degree
         oldcenter = self.rect.center
-        self.image = pygame.transform.rotate(self.image0, self.angle)
+        self.image = Rotcache.rotate(self.image0, self.angle)
         #self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
+        if getattr(self, "mask", None) is not None: # sprites without mask get one from collide_mask
+            self.mask = get_mask(self.image)
         self.rect = self.image.get_rect()
         self.rect.center = oldcenter
+        self.dirty = 1
 
     #def update(self, seconds):
     #    """calculate movement, position and bouncing on edge"""
@@ -460,17 +1514,15 @@ class VectorSprite(pygame.sprite.Sprite):
             self.create_image()
         # ---- movement with/without boss ----
         if self.bossnumber is not None:
+            boss = VectorSprite.numbers.get(self.bossnumber)
             if self.kill_with_boss:
-                if self.bossnumber not in VectorSprite.numbers:
+                if boss is None or boss.hitpoints <= 0:
                     self.kill()
-                elif VectorSprite.numbers[self.bossnumber].hitpoints <= 0:
-                    self.kill()
-            if self.sticky_with_boss and self.bossnumber in VectorSprite.numbers:
-
-                boss = VectorSprite.numbers[self.bossnumber]
+            if self.sticky_with_boss and boss is not None:
                 #print("bosspos", boss.pos)
                 self.pos = boss.pos # pygame.math.Vector2(boss.pos.x, boss.pos.y)
-                self.set_angle(boss.angle)
+                if boss.angle != self.angle:
+                    self.set_angle(boss.angle)
                 #print(self.number, self.bossnumber, boss)
         self.pos += self.move * seconds
         self.move *= self.friction
@@ -478,6 +1530,11 @@ class VectorSprite(pygame.sprite.Sprite):
         self.age += seconds
         #self.wallbounce()
         self.rect.center = (round(self.pos.x, 0), -round(self.pos.y, 0) + self.ydistance)
+        # ---- dirty: paint again (only needed for Viewer.dirtyrects) ----
+        drawn = (self.image, self.rect.topleft)
+        if drawn != self.drawn:
+            self.dirty = 1
+            self.drawn = drawn
         #if self.sticky_with_boss:
         #    print("self pos", self.pos)
         #    print("self rect center", self.rect.center)
@@ -567,22 +1624,32 @@ class Hitpointbar(VectorSprite):
 
 class Bar(VectorSprite):
     
+    images = {} # { (width, filled width, color): Surface }, shared by all bars
+    
     def _overwrite_parameters(self):
         self._layer = 19
         self.ydistance = -37
         self.width = 50
         self.sticky_with_boss = True
         self.kill_with_boss = True
-        self.always_create_image = True
+        self.hpseen = -1 # hpversion of the boss when the bar was painted
         #print("ich bin bar, meine Nummmer, meine bossnumber:", self.number, self.bossnumber)
+    
+    def update(self, seconds):
+        """paint the bar again only if hitpoints of the boss have changed"""
+        boss = VectorSprite.numbers.get(self.bossnumber)
+        if boss is not None and boss.hpversion != self.hpseen:
+            self.create_image()
+            self.set_angle(boss.angle)
+        VectorSprite.update(self, seconds)
           
     def create_image(self):
         try:
             boss = VectorSprite.numbers[self.bossnumber]
         except:
             return
+        self.hpseen = boss.hpversion
         width = self.width
-        self.image = pygame.Surface((width,10)) # size of rect
         percent = boss.hitpoints / boss.hitpointsfull
         w2 = int(width * percent)
         # moving inside filling
@@ -590,117 +1657,50 @@ class Bar(VectorSprite):
             c = (0,200,0)
         else:
             c = (200,200,200)
-        pygame.draw.rect(self.image,c, (1,1,w2,8)) 
-        # static outside border
-        pygame.draw.rect(self.image, (200,200,200), (0,0,width,10),1)
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
+        if (width, w2, c) not in Bar.images:
+            image = pygame.Surface((width,10)) # size of rect
+            pygame.draw.rect(image,c, (1,1,w2,8)) 
+            # static outside border
+            pygame.draw.rect(image, (200,200,200), (0,0,width,10),1)
+            image.set_colorkey((0,0,0))
+            image.convert_alpha()
+            Bar.images[(width, w2, c)] = image
+        self.image = Bar.images[(width, w2, c)]
         self.rect= self.image.get_rect()
-        self.image0 = self.image.copy()
+        self.image0 = self.image
         #self.rect.centerx = boss.rect.centerx
         #self.rect.centerx = boss.rect.centerx
         #self.rect.centery = boss.rect.centery - 100
     
 class Fireball(VectorSprite):
     
+    images = {} # { color: Surface }, shared by all fireballs of this color (and their mask)
+    
     def _overwrite_parameters(self):
         self.hitpoints = 1
         self.color = (255,0,255)
         
     def create_image(self):
-        self.image = pygame.Surface((10,10))
-        #self.image.fill(self.color)
-        pygame.draw.circle(self.image, self.color, (5,5),5)
-        #pygame.draw.rect(self.image, (0,0,0), (0,0,49,49),1)
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
-        self.image0 = self.image.copy()
+        if self.color not in Fireball.images:
+            image = pygame.Surface((10,10))
+            #image.fill(self.color)
+            pygame.draw.circle(image, self.color, (5,5),5)
+            #pygame.draw.rect(image, (0,0,0), (0,0,49,49),1)
+            image.set_colorkey((0,0,0))
+            Fireball.images[self.color] = image.convert_alpha()
+        self.image = Fireball.images[self.color]
+        self.image0 = self.image
+        self.mask = get_mask(self.image)
         self.rect = self.image.get_rect()
         
         
-class Wall(VectorSprite):
-    
-    def _overwrite_parameters(self):
-        self.color = (139, 105, 20)
-        self.hitpoints = 1
-        
-    def crack(self):
-        # border point
-        border = random.choice(("n","s","w","e"))
-        if border == "n":
-            x1 = random.randint(0, 50)
-            y1 = 0
-            x2 = random.randint(20,30)
-            y2 = random.randint(15,25)
-        if border == "s":
-            x1 = random.randint(0, 50)
-            y1 = 50
-            x2 = random.randint(20,30)
-            y2 = random.randint(25,35)
-        if border == "w":
-            x1 = 0
-            y1 = random.randint(0, 50)
-            x2 = random.randint(15,25)
-            y2 = random.randint(20,30)
-        if border == "e":
-            x1 = 50
-            y1 = random.randint(0, 50)
-            x2 = random.randint(25,35)
-            y2 = random.randint(20,30)
-        # draw crackline
-        thick = random.randint(1,3)
-        pygame.draw.line(self.image, (0,0,0), (x1,y1), (x2, y2), thick)
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
-            
-        
-        
-    def create_image(self):
-        new = [0,0,0]
-        for a in range(3):
-            c = self.color[a] + random.randint(-20,20)
-            c = min(c, 255)
-            c = max(c, 0)
-            new[a] = c
-        self.color = new
-        self.image = pygame.Surface((50,50))
-        self.image.fill(self.color)
-        pygame.draw.rect(self.image, (0,0,0), (0,0,49,49),1)
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
-        self.image0 = self.image.copy()
-        self.rect = self.image.get_rect()
-        #print(self.pos)
-            
-        
-        
-class WallBorder(Wall):
-    
-    def _overwrite_parameters(self):
-        self.color = (255, 50, 50)
-        self.hitpoints = 400
-        
-    def create_image(self):
-        Wall.create_image(self)
-        pygame.draw.line(self.image, (0,200,0), (0,0), 
-                         (49,49), 5)
-        pygame.draw.line(self.image, (0,200,0), (0,49), 
-                         (49,0), 5)
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
-        self.image0 = self.image.copy()
-        self.rect = self.image.get_rect()
-           
-    def crack(self):
-        pass # hahahaha, indestructable
-        
-    def update(self, seconds):
-        VectorSprite.update(self, seconds)
-        self.hitpoints = 400
-
-
 class Monster(VectorSprite):
     
+    occupant = "monster"
+    bar = False # True: a hitpoint Bar follows the monster
+    home = None # tile where the monster started patrolling
+    goal = None # tile the monster is walking to (without the player)
+    
     def _overwrite_parameters(self):
         self.lookright = True
         self.attacktime = 0
@@ -715,11 +1715,28 @@ class Monster(VectorSprite):
         self.state = NoneState()  # PatrolState() / SleepState()
         #self.state = SleepingState()
 
+    def _spawn_parameters(self):
+        if self.bar:
+            Prototypes.spawn(Bar, bossnumber=self.number)
+
     def on_event(self, event):
         self.state = self.state.on_event(event)
 
 
     def run_to_player(self):
+            """next step toward the player, following the shared Flowfield around walls"""
+            step = Flowfield.next_step(self.tile)
+            if step is not None:
+                return ((step[0] - self.tile[0]) * Viewer.tilesize,
+                        -(step[1] - self.tile[1]) * Viewer.tilesize)
+            if self.tile in Flowfield.distance:
+                return 0, 0 # no better tile free, wait
+            # --- outside of the Flowfield: plan room by room ---
+            if Pathfinder.level is not None:
+                dx, dy = self.walk_to(VectorSprite.numbers[1].tile)
+                if dx != 0 or dy != 0:
+                    return dx, dy
+            # --- outside of the Flowfield: walk straight toward the player ---
             playerpos = VectorSprite.numbers[1].pos
             dx, dy = 0, 0
             if self.pos.x < playerpos.x:
@@ -732,11 +1749,37 @@ class Monster(VectorSprite):
                 dy = Viewer.tilesize
             return dx, -dy
 
+    def walk_to(self, goal):
+        """next step (dx, dy) on the way to the tile goal, (0,0) if there is no path.
+           Far goals are planned room by room with Roomgraph, A* only runs to the next portal"""
+        path = Roomgraph.find_path(self.tile, goal)
+        if not path:
+            return 0, 0
+        x, y = path[0]
+        return (x - self.tile[0]) * Viewer.tilesize, -(y - self.tile[1]) * Viewer.tilesize
+    
+    def patrol(self):
+        """walk from home to a random tile of the home room and back again"""
+        if self.home is None:
+            self.home = self.tile
+        if self.goal is None or self.goal == self.tile:
+            room = Room.find(self.home)
+            if self.tile != self.home or room is None:
+                self.goal = self.home
+            else:
+                self.goal = (random.randint(room.x1, room.x2-1), random.randint(room.y1, room.y2-1))
+        dx, dy = self.walk_to(self.goal)
+        if dx == 0 and dy == 0:
+            self.goal = None # no way there, try another goal next turn
+        return dx, dy
+
     def ai(self):
-        playerpos = VectorSprite.numbers[1].pos
-        distance = (self.pos - playerpos ).length() // Viewer.tilesize
+        # --- steps to the player, walking around walls ---
+        distance = Flowfield.distance.get(self.tile, Flowfield.radius + 1)
         if distance < self.sniffrange:
             dx, dy = self.run_to_player() # -dy 
+        elif self.state.__str__() == "PatrolState" and Pathfinder.level is not None:
+            dx, dy = self.patrol()
         else:
             dx, dy = random.choice([(0,0), (0,0), (0,0),
                                     (-Viewer.tilesize, -Viewer.tilesize),
@@ -785,6 +1828,7 @@ class Monster(VectorSprite):
                 self.image = self.image0
             else:
                 self.image = self.image1
+        self.mask = get_mask(self.image)
         VectorSprite.update(self, seconds)
         
     #def moving_animation(self, duration=0.1):
@@ -803,21 +1847,26 @@ class Monster(VectorSprite):
         
     
     def create_image(self):
-        self.image=Viewer.images[self.imagenames[0]]   
+        """the 4 pictures are shared by all monsters with the same imagenames
+           (see Assets.get), never draw on them"""
         # stand normal, look right + left     
-        self.image0 = self.image.copy()
-        self.image1 = pygame.transform.flip(self.image, True, False)
+        self.image0 = Assets.get(self.imagenames[0])
+        self.image1 = Assets.get(self.imagenames[0], flipx=True)
         # attack, look right + left
-        self.image2 = Viewer.images[self.imagenames[1]]
-        self.image3 = pygame.transform.flip(self.image2, True, False)
+        self.image2 = Assets.get(self.imagenames[1])
+        self.image3 = Assets.get(self.imagenames[1], flipx=True)
         # move, look right + left 
-        #print(Viewer.images)
-        # self.image4 = Viewer.images[self.imagenames[2]]
-        # self.image5 = pygame.transform.flip(self.image4, True, False)
+        # self.image4 = Assets.get(self.imagenames[2])
+        # self.image5 = Assets.get(self.imagenames[2], flipx=True)
+        self.image = self.image0
+        self.mask = get_mask(self.image)
         self.rect = self.image.get_rect()
 
 class Wizard(Monster):
     
+    occupant = "player"
+    bar = True
+    
     def _overwrite_parameters(self):
         self.lookright = True
         self.attacktime = 0
@@ -830,7 +1879,6 @@ class Wizard(Monster):
         self.dx, self.dy = 0, 0
         self.sniffrange = 5
         #print("ich bin wizard", self.number)
-        Bar(bossnumber=self.number)
         #Hitpointbar(bossnumber=self.number, kill_with_boss=True,
         #            sticky_with_boss=True, ydistance=0, width=50,
         #            always_create_image=True)
@@ -838,6 +1886,8 @@ class Wizard(Monster):
 
 class Lizard(Monster):
     
+    bar = True
+    
     def _overwrite_parameters(self):
         self.attack = 5
         self.defense = 2
@@ -848,7 +1898,6 @@ class Lizard(Monster):
         self.imagenames = ["reptile", "reptile-a"]
         self.dx, self.dy = 0, 0
         self.sniffrange = 5
-        Bar(bossnumber=self.number)
         self.tired = 0
         self.state = PatrolState()
         self.bounty = 1
@@ -858,6 +1907,8 @@ class Lizard(Monster):
     
 class Wolf(Monster):
     
+    bar = True
+    
     def _overwrite_parameters(self):
         self.lookright = True
         self.attacktime = 0
@@ -871,12 +1922,13 @@ class Wolf(Monster):
         self.sniffrange = 5
         self.state = PatrolState()
         self.tired = 0
-        Bar(bossnumber=self.number)
         self.bounty = 4
 
   
 class Boss(Monster):
     
+   bar = True
+    
    def _overwrite_parameters(self):
         self.lookright = True
         self.attacktime = 0
@@ -890,13 +1942,14 @@ class Boss(Monster):
         self.sniffrange = 15
         self.state = BerserkState()
         self.tired = 0
-        Bar(bossnumber=self.number)
         self.bounty = 20
 
 
 
 class Chest(Monster):
     
+    occupant = "chest"
+    
     def _overwrite_parameters(self):
         self.lookright = True
         self.attacktime = 0
@@ -911,6 +1964,8 @@ class Chest(Monster):
         self.state = NoneState()
         self.tired = 500
         #Bar(bossnumber=self.number)
+    
+    def _spawn_parameters(self):
         self.bounty = random.randint(1,20)
     
     def ai(self):
@@ -920,6 +1975,8 @@ class Chest(Monster):
    
 class Shop(VectorSprite):
     
+    occupant = "shop"
+    
     def create_image(self):
         self.color = (0,0,222)
         self.image = pygame.Surface((50,50))
@@ -976,7 +2033,7 @@ class Cannon(VectorSprite):
                    angle=self.angle, move = v+self.move, color=self.color)
     
     def create_image(self):
-        self.image=Viewer.images["cannon"]
+        self.image = Assets.get("cannon")
         
         self.image0 = self.image.copy()
        # self.image0.set_colorkey((0,0,0))
@@ -1006,6 +2063,7 @@ class Cannon(VectorSprite):
         if self.selected:
             self.move = dist
             self.set_angle(angle)
+            self.image = self.image.copy() # the rotated image is shared by Rotcache
             pygame.draw.rect(self.image, (0,200,0), (0,0,self.rect.width, self.rect.height),1)
 
 
@@ -1047,6 +2105,8 @@ class Extra(VectorSprite):
    
 class Rocket(VectorSprite):
     
+    images = {} # { color: Surface }, shared by all rockets of this color (see Rotcache)
+    
     def _overwrite_parameters(self):
         self._layer = 9
         self.kill_on_edge = True
@@ -1072,13 +2132,16 @@ class Rocket(VectorSprite):
         VectorSprite.kill(self)
     
     def create_image(self):
-        self.image = pygame.Surface((30,10))
-        pygame.draw.circle(self.image, (1,1,1), (25,5), 5)
-        pygame.draw.rect(self.image, self.color, (0,0,25,10))
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
+        color = tuple(self.color)
+        if color not in Rocket.images:
+            image = pygame.Surface((30,10))
+            pygame.draw.circle(image, (1,1,1), (25,5), 5)
+            pygame.draw.rect(image, color, (0,0,25,10))
+            image.set_colorkey((0,0,0))
+            Rocket.images[color] = image.convert_alpha()
+        self.image = Rocket.images[color]
         self.rect= self.image.get_rect()
-        self.image0 = self.image.copy()                          
+        self.image0 = self.image
     
 
 class Bullet(VectorSprite):
@@ -1100,92 +2163,304 @@ class Bullet(VectorSprite):
         self.image0 = self.image.copy()                          
     
 
-class Gem(VectorSprite):
-
-    def _overwrite_parameters(self):
-        self._layer = 9
-        self.kill_on_edge = True
-
-    def create_image(self):
-        r = randomize_color(self.red, self.red_delta)
-        g = randomize_color(self.green, self.green_delta)
-        b = randomize_color(self.blue, self.blue_delta)
-        self.image = pygame.Surface((10,10)) 
-        pygame.draw.polygon(self.image, (r,g,b),
-             [(5,0), (10,3), (10,7), (5,10), (0,7), (0,3)])
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
-        self.rect= self.image.get_rect()
-        self.image0 = self.image.copy()                          
-        
+class Palette():
+    """pre-painted images for sparks and gems. For each (shape, color, delta) a set of
+       Palette.variants images with randomized colors (see randomize_color) is
+       painted once. A new particle only picks one of those shared images.
+       Turned images are painted when they are first needed, in steps of
+       360/Palette.steps degree"""
     
-
-class Spark(VectorSprite):
+    variants = 8 # color variants per set
+    maxsets = 256 # the least recently used set is painted over if there are more
+    book = collections.OrderedDict() # { (shape, color, delta): index in sets }, least recently used first
+    sets = [] # [ [Surface, Surface, ...], ... ]
+    steps = 24 # number of directions for turned images
+    turned = {} # { set index: { (variant, step): Surface } }
     
-    def _overwrite_parameters(self):
-        self._layer = 9
-        self.kill_on_edge = True
-        
-    def create_image(self):
-        #r,g,b = self.color
-        r = randomize_color(self.red, self.red_delta)
-        g = randomize_color(self.green, self.green_delta)
-        b = randomize_color(self.blue, self.blue_delta)
-        self.image = pygame.Surface((10,10))
-        pygame.draw.line(self.image, (r,g,b), 
-                         (10,5), (5,5), 3)
-        pygame.draw.line(self.image, (r,g,b),
-                          (5,5), (2,5), 1)
-        self.image.set_colorkey((0,0,0))
-        self.image.convert_alpha()
-        self.rect= self.image.get_rect()
-        self.image0 = self.image.copy()                          
-        
+    @staticmethod
+    def paint(shape, color):
+        """returns a new 10x10 image of a spark or gem, looking right"""
+        image = pygame.Surface((10,10))
+        if shape == "spark":
+            pygame.draw.line(image, color, (10,5), (5,5), 3)
+            pygame.draw.line(image, color, (5,5), (2,5), 1)
+        elif shape == "gem":
+            pygame.draw.polygon(image, color,
+                 [(5,0), (10,3), (10,7), (5,10), (0,7), (0,3)])
+        image.set_colorkey((0,0,0))
+        return image.convert_alpha()
+    
+    @staticmethod
+    def get(shape, color, delta):
+        """returns the index of the set for shape, color=(r,g,b) and delta=(dr,dg,db).
+           Similar colors (rounded down to a multiple of 8) share one set"""
+        color = tuple(int(c) // 8 * 8 for c in color)
+        key = (shape, color, delta)
+        if key in Palette.book:
+            Palette.book.move_to_end(key)
+            return Palette.book[key]
+        images = []
+        for v in range(Palette.variants):
+            c = tuple(randomize_color(color[i], delta[i]) for i in range(3))
+            images.append(Palette.paint(shape, c))
+        if len(Palette.sets) < Palette.maxsets:
+            index = len(Palette.sets)
+            Palette.sets.append(images)
+        else:
+            index = Palette.evict()
+            Palette.sets[index] = images
+        Palette.book[key] = index
+        return index
+    
+    @staticmethod
+    def pick(shape, color, delta):
+        """returns one of the shared images, do not draw on it"""
+        return random.choice(Palette.sets[Palette.get(shape, color, delta)])
+    
+    @staticmethod
+    def turn(index, variant, step):
+        """returns the image variant of set index, turned by step * 360/Palette.steps degree"""
+        turned = Palette.turned.setdefault(index, {})
+        key = (variant, step)
+        if key not in turned:
+            turned[key] = pygame.transform.rotate(Palette.sets[index][variant],
+                                                  step * 360 / Palette.steps)
+        return turned[key]
+    
+    @staticmethod
+    def evict():
+        """forget the least recently used set that no living particle shows and return its
+           index for a new set. If all sets are shown, the least recently used one is taken"""
+        shown = set(Particles.palette.tolist())
+        for key, index in Palette.book.items():
+            if index not in shown:
+                break
+        else:
+            key, index = next(iter(Palette.book.items()))
+        del Palette.book[key]
+        Palette.turned.pop(index, None)
+        return index
+
+
+class Particles():
+    """sparks and gems of all Explosions. Instead of one VectorSprite per spark,
+       every particle is one row in some numpy arrays. update moves all particles
+       with a few array operations, draw blits those inside the Camera viewport
+       (with shared images from the Palette).
+       Particles are drawn below all sprites (like the old layer 9)"""
+    
+    maxparticles = 20000 # oldest particles are forgotten if there are more
+    pos = numpy.zeros((0, 2))     # world pixel, y is negative like VectorSprite.pos
+    move = numpy.zeros((0, 2))    # pixel per second
+    gravity = numpy.zeros((0, 2)) # pixel per second per second, added to move
+    age = numpy.zeros(0)
+    lifetime = numpy.zeros(0)
+    angle = numpy.zeros(0)        # in degree, 0 is right, 90 is up
+    palette = numpy.zeros(0, dtype=numpy.int32) # index of the image set in Palette.sets
+    variant = numpy.zeros(0, dtype=numpy.uint8) # index of the image inside the set
+    fields = ("pos", "move", "gravity", "age", "lifetime", "angle", "palette", "variant")
+    
+    @staticmethod
+    def emit(x, y, angles, speeds, lifetimes, palette, gravity=None):
+        """adds len(angles) particles at world position x, y (y negative).
+           angles, speeds, lifetimes are 1d arrays, palette is an index in Palette.sets"""
+        n = len(angles)
+        radians = numpy.radians(angles)
+        new = {"pos": numpy.tile((x, y), (n, 1)).astype(float),
+               "move": numpy.column_stack((numpy.cos(radians), numpy.sin(radians))) * speeds[:, None],
+               "gravity": numpy.tile((0, 0) if gravity is None else (gravity[0], gravity[1]), (n, 1)).astype(float),
+               "age": numpy.zeros(n),
+               "lifetime": lifetimes,
+               "angle": angles,
+               "palette": numpy.full(n, palette, dtype=numpy.int32),
+               "variant": numpy.random.randint(0, Palette.variants, n).astype(numpy.uint8)}
+        for name in Particles.fields:
+            values = numpy.concatenate((getattr(Particles, name), new[name]))
+            setattr(Particles, name, values[-Particles.maxparticles:])
+    
+    @staticmethod
+    def update(seconds):
+        """moves all particles and forgets those that are older than their lifetime"""
+        if len(Particles.age) == 0:
+            return
+        Particles.move += Particles.gravity * seconds
+        Particles.pos += Particles.move * seconds
+        Particles.age += seconds
+        alive = Particles.age < Particles.lifetime
+        if not alive.all():
+            for name in Particles.fields:
+                setattr(Particles, name, getattr(Particles, name)[alive])
+    
+    @staticmethod
+    def clear():
+        for name in Particles.fields:
+            setattr(Particles, name, getattr(Particles, name)[:0])
+    
+    @staticmethod
+    def draw(screen):
+        if len(Particles.age) == 0:
+            return
+        # --- screen position of all particles, only those on the screen are painted ---
+        x = Particles.pos[:, 0] - Camera.x
+        y = -Particles.pos[:, 1] - Camera.y
+        inside = numpy.flatnonzero((x > -10) & (x < Viewer.width + 10) &
+                                   (y > -10) & (y < Viewer.height + 10))
+        if len(inside) == 0:
+            return
+        steps = numpy.round(Particles.angle[inside] * Palette.steps / 360).astype(int) % Palette.steps
+        blits = []
+        for sx, sy, p, v, step in zip(x[inside].tolist(), y[inside].tolist(), Particles.palette[inside].tolist(),
+                                      Particles.variant[inside].tolist(), steps.tolist()):
+            image = Palette.turn(p, v, step)
+            w, h = image.get_size()
+            blits.append((image, (sx - w // 2, sy - h // 2)))
+        screen.blits(blits, False)
+
 
 class Explosion():
-    """emits a lot of sparks, for Explosion or Player engine"""
+    """emits a lot of sparks, for Explosion or Player engine.
+       The sparks (or gems) are stored in Particles, not as sprites"""
     def __init__(self, posvector, minangle=0, maxangle=360, maxlifetime=3,
                  minspeed=5, maxspeed=150, red=255, red_delta=0, 
                  green=225, green_delta=25, blue=0, blue_delta=0,
                  minsparks=5, maxsparks=20, 
                  shape="spark", gravity = None):
-                     
-                     
-        for s in range(random.randint(minsparks,maxsparks)):
-            v = pygame.math.Vector2(1,0) # vector aiming right (0°)
-            a = random.randint(minangle,maxangle)
-            v.rotate_ip(a)
-            speed = random.randint(minspeed, maxspeed)
-            duration = random.random() * maxlifetime # in seconds
-            #red   = randomize_color(red, red_delta)
-            #green = randomize_color(green, green_delta)
-            #blue  = randomize_color(blue, blue_delta)
-            
-            if shape == "spark":
-                Spark(pos=pygame.math.Vector2(posvector.x, posvector.y),
-                      angle= a, move=v*speed, max_age = duration, 
-                      red=red, green=green, blue=blue,
-                      red_delta = red_delta, green_delta = green_delta, blue_delta=blue_delta,
-                      kill_on_edge = True, gravity=gravity)
-            elif shape == "gem":
-                Gem(pos=pygame.math.Vector2(posvector.x, posvector.y),
-                      angle= a, move=v*speed, max_age = duration, 
-                      red=red, green=green, blue=blue,
-                      red_delta = red_delta, green_delta = green_delta, blue_delta=blue_delta,
-                      kill_on_edge = True, gravity=gravity)
+        n = random.randint(minsparks, maxsparks)
+        angles = numpy.random.uniform(minangle, maxangle, n)
+        speeds = numpy.random.uniform(minspeed, maxspeed, n)
+        lifetimes = numpy.random.random(n) * maxlifetime # in seconds
+        palette = Palette.get(shape, (red, green, blue), (red_delta, green_delta, blue_delta))
+        Particles.emit(posvector.x, posvector.y, angles, speeds, lifetimes, palette, gravity)
+
+
+class Hudtext(pygame.sprite.DirtySprite):
+    """text (or log panel) in screen coordinates on top of all sprites, for
+       Viewer.draw_dirty. LayeredDirty paints it again only if the image has changed
+       or a sprite below has changed"""
+    
+    def __init__(self, x, y, layer=100):
+        pygame.sprite.DirtySprite.__init__(self)
+        self._layer = layer
+        self.image = pygame.Surface((0,0))
+        self.rect = self.image.get_rect(topleft=(x, y))
+    
+    def set_image(self, image):
+        """image should be shared (Textcache, Log.render), so an unchanged text is the same Surface"""
+        if image is not self.image:
+            self.image = image
+            self.rect = image.get_rect(topleft=self.rect.topleft)
+            self.dirty = 1
 
 
-        
+class Logentry():
+    """one entry of the Log as a record: what happened (event), who (class names) and the dice.
+       The text is only formatted when the entry is shown (text) or exported (export)"""
+    
+    colors = {"strikes at": (0,255,0), "strikes back": (0,200,0), "strike": (255,255,255)}
+    
+    def __init__(self, event, attacker, defender, attack=0, defense=0, dice=(), damage=0):
+        self.event = event # "strikes at", "strikes back" or "strike"
+        self.attacker = attacker # class name
+        self.defender = defender # class name
+        self.attack = attack
+        self.defense = defense
+        self.dice = dice # (d1, d2, d3, d4): 2d6 for attack and 2d6 for defense
+        self.damage = damage
+    
+    def color(self):
+        return Logentry.colors[self.event]
+    
+    def text(self):
+        if self.event == "strikes at":
+            return "{} strikes at {}".format(self.attacker, self.defender)
+        if self.event == "strikes back":
+            return "{} strikes back against {}".format(self.attacker, self.defender)
+        d1, d2, d3, d4 = self.dice
+        text = "hit!" if self.damage > 0 else "fail..."
+        text += " attack+2d6 = {} + {} + {} = {} Vs. defense+2d6 = {} + {} + {} = {}".format(
+                self.attack, d1, d2, self.attack+d1+d2, self.defense, d3, d4, self.defense + d3+d4)
+        if self.damage > 0:
+            text += "  DAMAGE {} HP".format(self.damage)
+        return text
+    
+    def export(self):
+        """machine readable version of the entry, one line of json"""
+        return json.dumps({"event": self.event, "attacker": self.attacker, "defender": self.defender,
+                           "attack": self.attack, "defense": self.defense, "dice": list(self.dice),
+                           "damage": self.damage})
+
+
+class Log():
+    """message log of the game. Stores the last maxlines Logentry records in a
+       ring buffer, older entries are written (as json lines) to the file spillfile
+       (if not None) before they are forgotten. The visible lines are painted on a cached panel
+       surface that only changes when a new entry arrives or the number of 
+       visible lines changes, so showing the log costs one blit per frame"""
+    
+    def __init__(self, maxlines=1000, spillfile=None):
+        self.lines = collections.deque(maxlen=maxlines)
+        self.spillfile = spillfile
+        self.spill = None # open file, see append
+        self.version = 0 # increases with every new entry
+        self.panel = None
+        self.panelkey = None # (version, loglines, width, height) of the painted panel
+    
+    def append(self, entry):
+        if self.spillfile is not None and len(self.lines) == self.lines.maxlen:
+            if self.spill is None:
+                self.spill = open(self.spillfile, "a")
+            self.spill.write(self.lines[0].export() + "\n")
+        self.lines.append(entry)
+        self.version += 1
+    
+    def export(self, filename):
+        """write all stored entries as json lines into the file filename"""
+        with open(filename, "w") as f:
+            for entry in self.lines:
+                f.write(entry.export() + "\n")
+    
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
     
+    def __len__(self):
+        return len(self.lines)
     
+    def __getitem__(self, i):
+        return self.lines[i]
+    
+    def __iter__(self):
+        return iter(self.lines)
+    
+    def render(self, loglines, fontsize=12, linesize=10):
+        """returns the panel with the last loglines entries. The panel is shared and only
+           painted again when the log (or the screen size) has changed"""
+        key = (self.version, loglines, Viewer.width, Viewer.height)
+        if key != self.panelkey:
+            self.panel = pygame.Surface((Viewer.width - Viewer.width // 2, loglines * linesize),
+                                        pygame.SRCALPHA)
+            for i in range(-loglines, 0):
+                if -i > len(self.lines):
+                    continue
+                entry = self.lines[i]
+                write(self.panel, entry.text(), x=0, y=(loglines + i) * linesize, color=entry.color(), fontsize=fontsize)
+            self.panelkey = key
+        return self.panel
+    
+    def draw(self, screen, loglines, fontsize=12, linesize=10):
+        """blit the last loglines entries to the bottom half of the screen (right side)"""
+        if loglines <= 0:
+            return
+        screen.blit(self.render(loglines, fontsize, linesize), (Viewer.width // 2, Viewer.height - loglines * linesize))
+
 
 class Viewer(object):
     width = 0
     dungeon = []
-    log = []
+    log = Log(maxlines=1000) # set Viewer.log.spillfile to a filename to keep older entries
     gold = 0
     height = 0
-    images = {}
     sounds = {}
     #inventory = []
     history = ["main"]
@@ -1194,23 +2469,29 @@ class Viewer(object):
     tilesize = 50
     maxx = 44
     maxy = 22
+    rooms = 10 # how many rooms create_textlevel tries to create
+    generator = "random" # "random": try random places for rooms, "bsp": binary space partition
+    verbose = False # print debug messages during level generation
     fullscreen = False
+    dirtyrects = False # paint and update only the changed parts of the screen (see draw_dirty)
     gamemenu =  {"main":            ["resume", "use", "equip", "settings", "credits", "quit" ],
             #main
             # cheatmenu 
             "use" :      ["back",],
             "equip":     ["back",],
            
-            "settings":        ["back", "video", "tile size", "max. tiles x", "max. tiles y" ],
+            "settings":        ["back", "video", "tile size", "max. tiles x", "max. tiles y", "room generator" ],
             #settings
             "tile size":       ["back", "25x25", "50x50", "75x75", "100x100"],
             "max. tiles x":    ["back", "10", "20", "30", "50", "100", "150", "200", "250"],
             "max. tiles y":    ["back", "10", "20", "30", "50", "100", "150", "200", "250"],
-            "video":           ["back", "resolution", "fullscreen"],
+            "room generator":  ["back", "random", "bsp"],
+            "video":           ["back", "resolution", "fullscreen", "dirty rects"],
             #difficulty
            
     
-            "fullscreen":      ["back", "true", "false"]
+            "fullscreen":      ["back", "true", "false"],
+            "dirty rects":     ["back", "true", "false"]
             }
     
     shopmenu = {"main": [ "resume", "earn money", "buy", "sell", "show inventory"],
@@ -1297,6 +2578,16 @@ class Viewer(object):
         self.loadbackground()
     
     
+    def set_tilesize(self, tilesize):
+        """world pixel coordinates are tile * Viewer.tilesize, so all sprites
+           move with the new tile size and stay on their tiles"""
+        factor = tilesize / Viewer.tilesize
+        Viewer.tilesize = tilesize
+        for s in self.allgroup:
+            if isinstance(s, VectorSprite):
+                s.pos *= factor
+        Occupancy.rebuild()
+    
     def loadbackground(self):
         
         self.background = pygame.Surface(self.screen.get_size()).convert()
@@ -1309,47 +2600,12 @@ class Viewer(object):
     
   
     
-    def load_sprites(self):
-            """ all sprites that can rotate MUST look to the right. Edit Image files manually if necessary!"""
-            print("loading sprites from 'data' folder....")
-            #Viewer.images["catapult1"]= pygame.image.load(
-            #     os.path.join("data", "catapultC1.png")).convert_alpha()
-            
-            ##self.create_selected("catapult1")
-            
-            #Viewer.images["cannon"] = pygame.image.load(os.path.join("data", "cannon.png"))
-            Viewer.images["wizard"] = pygame.image.load(os.path.join(
-                                      "data", "arch-mage.png"))
-            Viewer.images["reptile"] = pygame.image.load(os.path.join(
-                                       "data", "fighter.png"))
-            Viewer.images["wizard-a"] = pygame.image.load(os.path.join(
-                                      "data", "arch-mage-attack.png"))
-            Viewer.images["reptile-a"] = pygame.image.load(os.path.join(
-                                       "data", "fighter-attack.png"))
-            Viewer.images["wolf"] = pygame.image.load(os.path.join(
-                                        "data", "wolf.png"))
-            Viewer.images["wolf-a"] = pygame.image.load(os.path.join(
-                                        "data","wolf-attack.png"))
-            Viewer.images["chest"] = pygame.image.load(os.path.join(
-                                        "data", "chest-plain-closed.png"))
-            Viewer.images["chest-a"] = pygame.image.load(os.path.join(
-                                        "data", "chest-plain-open.png"))
-            # --- boss images (scaled to be bigger) ---
-            #Viewer.images["bosswolf"] = pygame.image.load(os.path.join(
-            #                            "data", "bosswolf.png"))
-            i = pygame.image.load(os.path.join(
-                                        "data", "wolf.png"))
-            Viewer.images["bosswolf"] = pygame.transform.scale(i, (150,150))
-            i = pygame.image.load(os.path.join(
-                                        "data","wolf-attack.png"))                                                    
-            Viewer.images["bosswolf-a"] = pygame.transform.scale(i, (150,150))                                                    
-                                    
-            
-     
     def prepare_sprites(self):
         """painting on the surface and create sprites"""
-        self.load_sprites()
         self.allgroup =  pygame.sprite.LayeredUpdates() # for drawing
+        self.dirtykey = None # see draw_dirty
+        self.hud = {}
+        self.gridkey = None # see grid_layer
         self.flytextgroup = pygame.sprite.Group()
         #self.mousegroup = pygame.sprite.Group()
         
@@ -1359,7 +2615,6 @@ class Viewer(object):
         self.enemygroup = pygame.sprite.Group()
         self.friendlygroup = pygame.sprite.Group()
         self.neutralgroup = pygame.sprite.Group()
-        self.wallgroup = pygame.sprite.Group()
         self.missilegroup = pygame.sprite.Group()
         self.bargroup = pygame.sprite.Group()
         self.shopgroup = pygame.sprite.Group()
@@ -1373,7 +2628,6 @@ class Viewer(object):
         Monster.groups = self.allgroup, self.enemygroup
         Wizard.groups = self.allgroup, self.friendlygroup
         #Wolf.groups = self.allgroup, self.enemygroup
-        Wall.groups = self.allgroup, self.wallgroup
         Bar.groups = self.allgroup, self.bargroup
         Fireball.groups = self.allgroup, self.missilegroup
         #Catapult.groups = self.allgroup,
@@ -1388,6 +2642,7 @@ class Viewer(object):
     def menu_run(self):
         running = True
         pygame.mouse.set_visible(False)
+        self.dirtykey = None # paint everything again after the menu
         
         
         while running:
@@ -1408,10 +2663,10 @@ class Viewer(object):
                     if event.key == pygame.K_d:
                         x = random.randint(0,Viewer.width)
                         y = random.randint(-Viewer.height, 0)
-                        g = pygame.math.Vector2(0, -1.5)
+                        g = pygame.math.Vector2(0, -90) # pixel per second per second
                         #Gem(pos=pygame.math.Vector2(x,y),
                         #    max_age = 2)
-                        Explosion(posvector=pygame.math.Vector2(x,y),
+                        Explosion(posvector=pygame.math.Vector2(x + Camera.x, y - Camera.y),
                                   shape="gem", gravity=g)
                         
                     
@@ -1455,8 +2710,9 @@ class Viewer(object):
                             #Viewer.gold += 1
                             # ----- Tomato Explosion ------
                             Explosion(red=0, green=220, blue=0, maxlifetime=5, maxspeed=250,
-                                      green_delta=25, minangle=70, maxangle=110, gravity=pygame.math.Vector2(0,-5), 
-                                      posvector=pygame.math.Vector2(random.randint(0, Viewer.width),-Viewer.height + 5)
+                                      green_delta=25, minangle=70, maxangle=110, gravity=pygame.math.Vector2(0,-300), 
+                                      posvector=pygame.math.Vector2(random.randint(0, Viewer.width) + Camera.x,
+                                                                    -Viewer.height + 5 - Camera.y)
                                       )
                         ### item to buy or sell. MUST have price in round brackets at the end, e.g. 'rusty sword (18)'
                         elif text[-1] == ")" and text.find("(") != -1:
@@ -1523,7 +2779,7 @@ class Viewer(object):
                                 x = int(text[:t])
                                 y = int(text[t+1:])
                                 if x == y:
-                                    Viewer.tilesize = x
+                                    self.set_tilesize(x)
                                     print("setting grid size to ", x)
                                     # !!! Flytext als erstes Sprite....player soll erstes Sprite sein!
                                     #Flytext(text="set grid_size to {} x {}".format(Viewer.grid_size, Viewer.grid_size),
@@ -1539,6 +2795,11 @@ class Viewer(object):
                             if text != Viewer.name:
                                 Viewer.maxy = int(text)
                                 print("setiing max. y tiles to", int(text))
+                        
+                        elif Viewer.name == "room generator":
+                            if text in ("random", "bsp"):
+                                Viewer.generator = text
+                                print("setting room generator to", text)
                             
                         elif Viewer.name == "fullscreen":
                             if text == "true":
@@ -1550,6 +2811,11 @@ class Viewer(object):
                                 Viewer.fullscreen = False
                                 self.set_resolution()
                         
+                        elif Viewer.name == "dirty rects":
+                            if text in ("true", "false"):
+                                Viewer.dirtyrects = text == "true"
+                                print("setting dirty rects to", text)
+                        
             # ------delete everything on screen-------
             self.screen.blit(self.background, (0, 0))
             
@@ -1558,9 +2824,11 @@ class Viewer(object):
             # -------------- UPDATE all sprites -------             
             #self.flytextgroup.update(seconds)
             self.allgroup.update(seconds)
+            Particles.update(seconds)
 
             # ----------- clear, draw , update, flip -----------------
-            self.allgroup.draw(self.screen)
+            Particles.draw(self.screen)
+            Camera.draw(self.allgroup, self.screen)
             # --- paint gold ---
             write(self.screen, text="You have {} gold.".format(Viewer.gold),x=20, y=20, color=(200,200,0))
             # --- paint menu ----
@@ -1590,46 +2858,99 @@ class Viewer(object):
         return True 
     
     
-    def paint_dungeon(self):
-        # --- paint a 50 x 50 grid ----
-        c = (128,128,128) # grey
-        for x in range(0, Viewer.width+Viewer.tilesize, Viewer.tilesize):
-            pygame.draw.line(self.screen, c, (x-Viewer.tilesize//2,0), (x-Viewer.tilesize//2, Viewer.height))
-        for y in range(0, Viewer.height+Viewer.tilesize, Viewer.tilesize):
-            pygame.draw.line(self.screen, c, (0, y-Viewer.tilesize//2), (Viewer.width, y-Viewer.tilesize//2))
+    def grid_layer(self):
+        """returns the background with the grid painted on it, one tile bigger than
+           the screen, so that it can scroll with the Camera (see paint_dungeon). It is painted
+           only once and again only if the tile size or the resolution (background) has changed.
+           The background must have one color, because it scrolls with the grid"""
+        key = (Viewer.tilesize, self.background)
+        if key != self.gridkey:
+            ts = Viewer.tilesize
+            w, h = self.background.get_size()
+            self.gridlayer = pygame.Surface((w + ts, h + ts)).convert()
+            for x, y in ((0, 0), (w, 0), (0, h), (w, h)):
+                self.gridlayer.blit(self.background, (x, y))
+            # --- paint a 50 x 50 grid ----
+            c = (128,128,128) # grey
+            for x in range(0, w + ts, ts):
+                pygame.draw.line(self.gridlayer, c, (x, 0), (x, h + ts))
+            for y in range(0, h + ts, ts):
+                pygame.draw.line(self.gridlayer, c, (0, y), (w + ts, y))
+            self.gridkey = key
+        return self.gridlayer
+    
+    def paint_dungeon(self, surface=None):
+        """blit background and grid, scrolling with the Camera (one blit, see grid_layer)"""
+        if surface is None:
+            surface = self.screen
+        startx, starty = Camera.to_screen(-Viewer.tilesize//2, -Viewer.tilesize//2)
+        startx %= Viewer.tilesize
+        starty %= Viewer.tilesize
+        surface.blit(self.grid_layer(), (startx - Viewer.tilesize, starty - Viewer.tilesize))
+    
+    def draw_dirty(self, loglines):
+        """paints only sprites that have changed (or were covered by changed sprites)
+           and updates only those parts of the display, see Camera.draw_dirty.
+           When the Camera scrolls, walls change or Particles fly, the background 
+           changes and everything is painted. A frame where nothing moves costs (almost) nothing"""
+        key = (Camera.x, Camera.y, Tilemap.version, Viewer.width, Viewer.height, Viewer.tilesize,
+               self.age if len(Particles.age) > 0 else None)
+        if key != self.dirtykey:
+            self.dungeonbackground = self.background.copy()
+            self.paint_dungeon(self.dungeonbackground)
+            Tilemap.draw(self.dungeonbackground)
+            Particles.draw(self.dungeonbackground)
+            if key[3:6] != (self.dirtykey or ())[3:6]:
+                self.hud = {"fps":  Hudtext(Viewer.width - 200, 10),
+                            "gold": Hudtext(Viewer.width - 300, 10),
+                            "log":  Hudtext(Viewer.width // 2, Viewer.height - loglines * 10)}
+            self.dirtykey = key
+        self.hud["fps"].set_image(Textcache.render("FPS: {:8.3}".format(self.clock.get_fps()),
+                                                   (0,255,0), 'mono', 12, bold=True))
+        self.hud["gold"].set_image(Textcache.render("gold: {}".format(VectorSprite.numbers[1].gold),
+                                                    (255,255,0), 'mono', 24, bold=True))
+        self.hud["log"].set_image(Viewer.log.render(loglines))
+        # --- PAGEUP / PAGEDOWN change the height of the log panel, its bottom stays at the screen edge ---
+        if self.hud["log"].rect.bottomleft != (Viewer.width // 2, Viewer.height):
+            self.hud["log"].rect.bottomleft = (Viewer.width // 2, Viewer.height)
+            self.hud["log"].dirty = 1
+        rects = Camera.draw_dirty(self.allgroup, self.screen, self.dungeonbackground, self.hud.values())
+        pygame.display.update(rects)
         
     def create_textlevel(self):
+        """creates self.level, a numpy uint8 array [y, x] of tile codes (see LEGEND and self.legend)
+           with Viewer.rooms rooms connected by corridors.
+           time budget: a 250x250 map with 200 rooms must be ready in less than 0.1 seconds
+           (text level only, without creating sprites). Set Viewer.verbose to watch it"""
         self.legend = {".":"floor",
                        "#":"wall",
                        "~":"outer wall",
                        "$":"shop",
+                       "+":"corridor",
                        }
-        self.level = []
-        for y in range(self.maxy):
-            line = []
-            for x in range(self.maxx):
-                line.append("#") # fill everything with walls
-            self.level.append(line)
+        # --- fill everything with walls ---
+        self.level = numpy.full((self.maxy, self.maxx), WALL, dtype=numpy.uint8)
         # --- outer walls [~] ---
-        for y in range(self.maxy):
-            for x in range(self.maxx):
-                if y== 0 or y == self.maxy-1: 
-                    self.level[y][x] = "~"
-                elif x == 0 or x == self.maxx- 1:
-                    self.level[y][x] = "~"
+        self.level[[0, -1], :] = OUTERWALL
+        self.level[:, [0, -1]] = OUTERWALL
         
-        #- -- create 10 rooms (or try it) ----
-        for _ in range(10):
-            Room(xmin=1, xmax=self.maxx-2,ymin=1, ymax=self.maxy-2)
+        #- -- create Viewer.rooms rooms (or try it) ----
+        Room.book = {}
+        Room.number = 0
+        if Viewer.generator == "bsp":
+            Room.bsp(Viewer.rooms, xmin=1, xmax=self.maxx-2,ymin=1, ymax=self.maxy-2)
+        else:
+            for _ in range(Viewer.rooms):
+                Room(xmin=1, xmax=self.maxx-2,ymin=1, ymax=self.maxy-2)
         # --- fill rooms with floor tiles ---
         for r in Room.book.values():
-            for y in range(r.y1, r.y2):
-                for x in range(r.x1, r.x2):
-                    self.level[y][x] = "." # str(r.number)
+            self.level[r.y1:r.y2, r.x1:r.x2] = FLOOR
         # --- connect rooms with corridors 
+        corridorx, corridory = [], [] # all corridor tiles, written into self.level at once
         maxr = len(Room.book)
         for number in range(maxr-1):
-            print("processing room number", number)
+            if Viewer.verbose:
+                print("processing room number", number)
             r = Room.book[number]
             r2= Room.book[number + 1]
             
@@ -1655,81 +2976,65 @@ class Viewer(object):
             # --- crawl the corridor ---
             x = x1
             y = y1
-            print("dx,dy",dx,dy)
+            if Viewer.verbose:
+                print("dx,dy",dx,dy)
             
             while not (x == x2 and y == y2):
                 
                 if x != x2:
                     x += dx
                 if y != y2 and random.random() < 0.1:
-                    self.level[y][x] = "+"
+                    corridorx.append(x)
+                    corridory.append(y)
                     y += dy
                 # TODO: curves in corridor for better look
-                self.level[y][x] = "+"
+                corridorx.append(x)
+                corridory.append(y)
+        self.level[corridory, corridorx] = CORRIDOR
+        # --- one shop in a random room ---
+        if len(Room.book) > 0:
+            r = random.choice(list(Room.book.values()))
+            self.level[random.randint(r.y1, r.y2-1), random.randint(r.x1, r.x2-1)] = SHOP
+        Pathfinder.new_level(self.level)
                 
                     
           
     def create_level(self):
-        self.create_textlevel()
-        for line in self.level:
-            print(line)
-        #print(self.level)
-        # --- kill old walls ----
-        for w in self.wallgroup:
-            w.kill()
         # --- kill old shop ----
         for s in self.shopgroup:
             s.kill()
-        # --- outer wall ---
-        #for x in range(0, Viewer.width, 50):
-        #    WallBorder(pos=pygame.math.Vector2(x, 0))
-        #for y in range(50, Viewer.height, 50):
-        #    WallBorder(pos=pygame.math.Vector2(0,-y))
-        #for x2 in range(0, x, 50):
-        #    WallBorder(pos=pygame.math.Vector2(x2, -y-50))
-        #for y2 in range(0, Viewer.height, 50):
-        #    WallBorder(pos=pygame.math.Vector2(x, -y2-50))
-        # -------- random shop ------------
-        #sx = random.choice(range(50, Viewer.width-50,50))
-        #sy = random.choice(range(50, Viewer.height-50, 50))
-        #Shop(pos=pygame.math.Vector2(sx, -sy))
-        
-        # -------- random blocks ----------
-        #for x in range(50, Viewer.width-50, 50):
-        #    for y in range(50, Viewer.height-50, 50):
-        #        if x==sx and y == sy:
-        #            continue # no Wall on top of shop
-        #        if random.random() < 0.15:
-        #            Wall(pos=pygame.math.Vector2(x,-y))
-        
-        # ---- create some random chests -----
-        #for x in range(50, Viewer.width-50, 50):
-        #    for y in range(50, Viewer.height-50, 50):
-        #        if random.random() < 0.05:
-        #            Chest(pos=pygame.math.Vector2(x, -y))
-        
-        # ---- create random enemies ------
-        #pool = ["wolf","wolf","wolf", "lizard"]
-        #for x in range(50, Viewer.width-50, 50):
-        #    for y in range(50, Viewer.height-50, 50):
-        #        # chance for a monster on this tile
-        #        if x == -self.player1.pos.x and y == -self.player1.pos.y:
-        #            continue  # no monster on top of player
-        #        if random.random() < 0.05:  # 5%
-        #            what = random.choice(pool)
-        #            if what=="wolf":
-        #                Wolf(pos=pygame.math.Vector2(x,-y))
-        #            if what=="lizard":
-        #                Lizard(pos=pygame.math.Vector2(x,-y))
-        
-        
-        # --- no wall on players / enemies -----
-        #for w in self.wallgroup:
-        #    if w.pos == self.player1.pos:
-        #        w.kill()
-        #    for e in self.enemygroup:
-        #        if w.pos == e.pos:
-        #            w.kill()
+        # --- the new level starts with an empty Occupancy index, only the player stays ---
+        Occupancy.clear()
+        Occupancy.add(self.player1)
+        self.create_textlevel()
+        if Viewer.verbose:
+            for line in self.level:
+                print("".join(LEGEND[c] for c in line))
+        # --- walls and outer walls are painted by the Tilemap, the shop is a sprite ----
+        Tilemap.new_level(self.level)
+        for y, x in numpy.argwhere(self.level == SHOP).tolist():
+            Shop(pos=pygame.math.Vector2(x * Viewer.tilesize, -y * Viewer.tilesize))
+        # ---- player starts in the first room ----
+        if len(Room.book) > 0:
+            r = Room.book[0]
+            self.player1.pos = pygame.math.Vector2((r.x1 + r.x2) // 2 * Viewer.tilesize,
+                                                   -((r.y1 + r.y2) // 2) * Viewer.tilesize)
+            Occupancy.moved(self.player1)
+        # ---- create some random chests and enemies in the rooms -----
+        pool = ["wolf","wolf","wolf", "lizard"]
+        for r in Room.book.values():
+            for y, x in (numpy.argwhere(self.level[r.y1:r.y2, r.x1:r.x2] == FLOOR) + (r.y1, r.x1)).tolist():
+                if (x, y) == self.player1.tile:
+                    continue # no monster on top of player
+                pos = pygame.math.Vector2(x * Viewer.tilesize, -y * Viewer.tilesize)
+                if random.random() < 0.05:  # 5%
+                    Prototypes.spawn(Chest, pos=pos)
+                elif random.random() < 0.05:  # 5%
+                    what = random.choice(pool)
+                    if what=="wolf":
+                        Prototypes.spawn(Wolf, pos=pos)
+                    if what=="lizard":
+                        Prototypes.spawn(Lizard, pos=pos)
     
     def run(self):
         """The mainloop"""
@@ -1745,7 +3050,7 @@ class Viewer(object):
         loglines = 8
         turn = 0
         oldturn = 0
-        self.level = 1
+        self.levelnumber = 1
         self.boss_done = False
         
         #pygame.mixer.music.play(loops=-1)
@@ -1774,27 +3079,27 @@ class Viewer(object):
                         
                     # --- spawn a boss -----
                     if event.key == pygame.K_e:
-                        Boss(pos=pygame.math.Vector2(50,-50))
+                        Prototypes.spawn(Boss, pos=pygame.math.Vector2(50,-50))
                     # --- move player 1 (wizard) -----
                   
                     if event.key == pygame.K_UP:
                         #self.player1.pos.y += 50
-                        dy = 50
+                        dy = Viewer.tilesize
                         turn += 1
                         
                     elif event.key == pygame.K_DOWN:
                         #self.player1.pos.y -= 50
-                        dy = -50
+                        dy = -Viewer.tilesize
                         turn += 1
                         
                     elif event.key == pygame.K_RIGHT:
-                        dx = 50
+                        dx = Viewer.tilesize
                         self.player1.lookright = True
                         turn += 1
                         
                         
                     elif event.key == pygame.K_LEFT:
-                        dx = -50
+                        dx = -Viewer.tilesize
                         self.player1.lookright = False
                         turn += 1
                     
@@ -1805,19 +3110,19 @@ class Viewer(object):
                         else:
                             x=-50
                         self.player1.attack_animation()
-                        Fireball(pos=pygame.math.Vector2(self.player1.pos.x, self.player1.pos.y),
-                                 move=pygame.math.Vector2(x, 0))
+                        Prototypes.spawn(Fireball, pos=pygame.math.Vector2(self.player1.pos.x, self.player1.pos.y),
+                                         move=pygame.math.Vector2(x, 0))
                         turn += 1
                     
                     if event.key == pygame.K_b:
                         # --- create a block ----
                         if self.player1.lookright:
-                            x=50
+                            x=Viewer.tilesize
                         else:
-                            x=-50
+                            x=-Viewer.tilesize
                         self.player1.attack_animation()
-                        Wall(pos=pygame.math.Vector2(self.player1.pos.x + x,
-                                                     self.player1.pos.y))
+                        Tilemap.build(Occupancy.tile(pygame.math.Vector2(self.player1.pos.x + x,
+                                                                         self.player1.pos.y)))
                         
                     
                     if event.key == pygame.K_PAGEUP:
@@ -1838,25 +3143,25 @@ class Viewer(object):
                         
             # ---- check wall for moving player 1
             if dx != 0 or dy != 0:
-                for w in self.wallgroup:
-                    if w.pos.x == self.player1.pos.x + dx and w.pos.y==self.player1.pos.y + dy:
+                target = Occupancy.tile(pygame.math.Vector2(self.player1.pos.x + dx,
+                                                            self.player1.pos.y + dy))
+                s = Occupancy.get("shop", target)
+                e = Occupancy.get("monster", target) or Occupancy.get("chest", target)
+                if not Pathfinder.passable(target):
                         self.player1.attack_animation()
-                        w.crack()
-                        w.hitpoints -= random.randint(1,10)
-                        direction = w.pos - self.player1.pos #- w.pos
+                        color = Tilemap.color(target)
+                        Tilemap.hit(target, random.randint(1,10))
+                        direction = pygame.math.Vector2(dx, dy) # from player to wall
                         direction.x *= -1 ## no idea why this is necessary, but it is
                         angle = direction.angle_to(pygame.math.Vector2(1,0))
                         # print("Angle:", angle)
                         Explosion(posvector = pygame.math.Vector2(
                                 self.player1.pos.x + dx//2, self.player1.pos.y + dy//2),
-                                red=w.color[0], green=w.color[1], blue=w.color[2],
+                                red=color[0], green=color[1], blue=color[2],
                                 minangle = angle-45, maxangle= angle+45)
                         dx , dy = 0, 0 # player must stop
-                        break
-                # ----- check enemy for moving player 1
-                for s in self.shopgroup:
-                    if (s.pos.x == self.player1.pos.x+dx and
-                        s.pos.y == self.player1.pos.y + dy):
+                # ----- check shop for moving player 1
+                elif s is not None:
                         dx, dy =0, 0
                         #self.player1.hitpoints += 10
                         
@@ -1869,10 +3174,8 @@ class Viewer(object):
                         running = self.menu_run() 
                         VectorSprite.numbers[1].gold = Viewer.gold
                         Viewer.menu = Viewer.gamemenu
-                for e in self.enemygroup:
-                    
-                    if e.pos.x == self.player1.pos.x + dx and e.pos.y==self.player1.pos.y + dy:
-                        
+                # ----- check enemy for moving player 1
+                elif e is not None:
                         ## fight
                         e.on_event("attacked")
                         e.tired -= 20 
@@ -1880,35 +3183,33 @@ class Viewer(object):
                         Explosion(posvector = pygame.math.Vector2(
                                 self.player1.pos.x + dx//2, self.player1.pos.y + dy//2))
                         dx , dy = 0, 0 # player must stop
-                        break
                 
                 # ---- move the player -----
                 self.player1.pos.x += dx
                 self.player1.pos.y += dy
+                Occupancy.moved(self.player1)
                         
             # ------------ move the (hostile) monsters -----
             if turn > oldturn:
+                Flowfield.update(self.player1.tile)
                 for e in self.enemygroup:
                     e.ai()
-                    # wall ?
-                    for w in self.wallgroup:
-                       if e.pos.x + e.dx == w.pos.x and e.pos.y + e.dy == w.pos.y:
+                    if e.dx == 0 and e.dy == 0:
+                        continue
+                    target = Occupancy.tile(pygame.math.Vector2(e.pos.x + e.dx, e.pos.y + e.dy))
+                    # wall or other (hostile) monster ?
+                    if (not Pathfinder.passable(target) or
+                        Occupancy.get("monster", target) is not None or
+                        Occupancy.get("chest", target) is not None):
                            e.dx, e.dy = 0, 0
-                           break
-                    # other (hostile) monster ?
-                    for e2 in self.enemygroup:
-                        if e2.number == e.number:
-                            continue
-                        if e.pos.x + e.dx == e2.pos.x and e.pos.y + e.dy == e2.pos.y:
-                            e.dx, e.dy = 0, 0
-                            break 
-                        # player ?
-                    if e.pos.x + e.dx == self.player1.pos.x and e.pos.y + e.dy == self.player1.pos.y:
+                    # player ?
+                    elif Occupancy.get("player", target) is not None:
                         fight(e, self.player1)
                         e.dx, e.dy = 0, 0
                     # ---- move the monster ------
                     e.pos.x += e.dx
                     e.pos.y += e.dy
+                    Occupancy.moved(e)
                         
                     
             # ---------------        
@@ -1957,8 +3258,7 @@ class Viewer(object):
                 
               
             # =========== delete everything on screen ==============
-            self.screen.blit(self.background, (0, 0))
-            self.paint_dungeon()
+            Camera.follow(self.player1)
             # ----trails for rockets------
             #for r in self.rocketgroup:
             #    if len(r.trail) > 1:
@@ -1972,36 +3272,31 @@ class Viewer(object):
                        
             # write text below sprites
            
-            # ----- collision detection between fireball and wall---
-            for w in self.wallgroup:
-                if w.pos == pygame.math.Vector2(0,0):
-                    continue # unnötige Borderwall
-                crashgroup=pygame.sprite.spritecollide(w,
-                           self.missilegroup, False, 
-                           pygame.sprite.collide_rect)
-                for o in crashgroup:
+            # ----- collision detection between fireball and wall tiles ---
+            for o in self.missilegroup:
+                if not Pathfinder.passable(Occupancy.tile(o.pos)):
                     Explosion(posvector = o.pos)
                     o.kill()
             
-            # ----- collision detection between fireball and wolf---
-            for e in self.enemygroup:
-                crashgroup=pygame.sprite.spritecollide(e,
-                           self.missilegroup, False, 
-                           pygame.sprite.collide_mask)
-                for o in crashgroup:
-                     #if o.boss.number == p.number:
-                     #    continue
-            #        #elastic_collision(o, p)
-                     Explosion(posvector=o.pos)
-                     o.kill()
-                     e.hitpoints -= 1
-            #        # p.hitpoints -= 1
+            # ----- collision detection between fireball and wolf, only monsters near the fireball ---
+            for o in self.missilegroup:
+                for e in Occupancy.near(("monster", "chest"), o.rect):
+                    if pygame.sprite.collide_mask(e, o):
+                        #if o.boss.number == p.number:
+                        #    continue
+                        #elastic_collision(o, p)
+                        Explosion(posvector=o.pos)
+                        o.kill()
+                        e.hitpoints -= 1
+                        # p.hitpoints -= 1
+                        break
             
                 
             
            
             # ================ UPDATE all sprites =====================
             self.allgroup.update(seconds)
+            Particles.update(seconds)
             # --- all enemys must look to player ----
             for e in self.enemygroup:
                 if e.pos.x < self.player1.pos.x:
@@ -2014,46 +3309,54 @@ class Viewer(object):
             if len(self.enemygroup) == 0:
                 # -- time for a boss ? ----
                 if not self.boss_done:
-                    for y in range(self.level):
-                        Boss(pos=pygame.math.Vector2(150,-100-50 * y))
+                    for y in range(self.levelnumber):
+                        if len(Room.book) == 0:
+                            Prototypes.spawn(Boss, pos=pygame.math.Vector2(150,-100-50 * y))
+                            continue
+                        # bosses appear in the last room
+                        r = Room.book[len(Room.book)-1]
+                        Prototypes.spawn(Boss, pos=pygame.math.Vector2(random.randint(r.x1, r.x2-1) * Viewer.tilesize,
+                                                                       -random.randint(r.y1, r.y2-1) * Viewer.tilesize))
                     self.boss_done = True
                 else:
-                    Flytext(pos=pygame.math.Vector2(Viewer.width//2, -Viewer.height),
-                            move=pygame.math.Vector2(0, 25), text="level {} cleared".format(self.level),
+                    Flytext(pos=pygame.math.Vector2(Viewer.width//2 + Camera.x, -Viewer.height - Camera.y),
+                            move=pygame.math.Vector2(0, 25), text="level {} cleared".format(self.levelnumber),
                             fontsize = 128, max_lifetime=5)
                     # 5 sec pause
-                    self.level += 1
+                    self.levelnumber += 1
                     self.create_level()
                     self.boss_done = False
 
             # ----------- clear, draw , update, flip -----------------
-            self.allgroup.draw(self.screen)
-            #print(self.allgroup)
-            # ----- FPS -----
-            write(self.screen, "FPS: {:8.3}".format(
-                self.clock.get_fps() ), x=Viewer.width-200, y=10, color=(0,255,0), fontsize=12)
-            
-            write(self.screen, "gold: {}".format(
-                  VectorSprite.numbers[1].gold), 
-                  x=Viewer.width - 300, y=10, 
-                  color=(255,255,0),
-                  fontsize = 24)
-            
-            # ----- log ------
-            for i in range(-loglines, 0):
-                try:
-                    textcolor, line = Viewer.log[i]
-                except:
-                    continue
-                write(self.screen, line, x=Viewer.width // 2, y=Viewer.height + i*10, color=textcolor, fontsize=12)
-            
-           
+            if Viewer.dirtyrects:
+                self.draw_dirty(loglines)
+            else:
+                self.paint_dungeon()
+                Tilemap.draw(self.screen)
+                Particles.draw(self.screen)
+                Camera.draw(self.allgroup, self.screen)
+                #print(self.allgroup)
+                # ----- FPS -----
+                write(self.screen, "FPS: {:8.3}".format(
+                    self.clock.get_fps() ), x=Viewer.width-200, y=10, color=(0,255,0), fontsize=12)
                 
-            # -------- next frame -------------
-            pygame.display.flip()
+                write(self.screen, "gold: {}".format(
+                      VectorSprite.numbers[1].gold), 
+                      x=Viewer.width - 300, y=10, 
+                      color=(255,255,0),
+                      fontsize = 24)
+                
+                # ----- log ------
+                Viewer.log.draw(self.screen, loglines)
+                    
+                # -------- next frame -------------
+                pygame.display.flip()
         #-----------------------------------------------------
-        for line in Viewer.log:
-            print(line[1])
+        for entry in Viewer.log:
+            print(entry.text())
+        Viewer.log.close()
+        print(Assets.stats())
+        print(Prototypes.stats())
         pygame.mouse.set_visible(True)    
         pygame.quit()
 